@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# ASGIサーバー向けのエントリーポイント
+#
+#   uvicorn asgi:app --port 8000
+#
+# /analyze（JSON・バイナリ）は asyncio で処理し、それ以外は Flask アプリに委譲する
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+import logs
+import main
+import metrics
+from auth import credential_provider
+from image_utils import ImageData
+from ratelimit import RateLimitExceeded
+from singleflight import AsyncSingleFlight
+from upstream import AsyncUpstreamClient
+
+# Flask に委譲したリクエストを処理するスレッド数。/analyze/stream は送り終えるまで1スレッドを使う
+WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', 64))
+wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """Flask アプリをリクエストごとにスレッドプールで動かす
+
+    asgiref の WsgiToAsgi はすべてのリクエストを1つの共有スレッドで順に処理するので、
+    ストリームが1本開いている間は他の Flask のルートもすべて待たされる。
+    """
+
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiToAsgiInstance(self.wsgi_application)(scope, receive, send)
+
+
+class ThreadPoolWsgiToAsgiInstance(WsgiToAsgiInstance):
+    async def run_wsgi_app(self, body):
+        await sync_to_async(self._run_wsgi_app, thread_sensitive=False, executor=wsgi_executor)(body)
+
+    def _run_wsgi_app(self, body):
+        # WsgiToAsgiInstance.run_wsgi_app と同じ処理に、WSGIの規約どおり close() の呼び出しを加えたもの
+        # （クライアントが切断した場合も /analyze/stream の後始末が動く）
+        environ = self.build_environ(self.scope, body)
+        output = self.wsgi_application(environ, self.start_response)
+        try:
+            bytes_sent = 0
+            for chunk in output:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                if self.response_content_length is not None:
+                    chunk = chunk[:self.response_content_length - bytes_sent]
+                self.sync_send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                bytes_sent += len(chunk)
+                if bytes_sent == self.response_content_length:
+                    break
+        finally:
+            if hasattr(output, 'close'):
+                output.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({'type': 'http.response.body'})
+
+
+flask_app = ThreadPoolWsgiToAsgi(main.app)
+upstream_client = AsyncUpstreamClient()
+inflight = AsyncSingleFlight()
+
+
+async def post_upstream(path, payload, stage_name):
+    with logs.stage('credentials'):
+        token = await credential_provider.get_token_async()
+    with logs.stage(stage_name):
+        return await upstream_client.post_json(
+            path,
+            payload,
+            headers={
+                'Authorization': f'Bearer {token}',
+                'Content-Type': 'application/json'
+            }
+        )
+
+
+async def call_analyze_api(image):
+    try:
+        response = await post_upstream(main.ANALYZE_PATH, main.build_analyze_payload(image), 'analyze')
+        return main.handle_vision_response(response, 'Analyze API')
+    except Exception as e:
+        logs.warning('upstream_call_failed', api='analyze', error=str(e))
+        raise
+
+
+async def call_vision_api(image):
+    try:
+        response = await post_upstream(main.VISION_PATH, main.build_vision_payload(image), 'vision')
+        return main.handle_vision_response(response)
+    except Exception as e:
+        logs.warning('upstream_call_failed', api='vision', error=str(e))
+        raise
+
+
+async def call_generate_api(vision_response):
+    try:
+        response = await post_upstream(
+            main.GENERATE_PATH, main.build_generate_payload(vision_response), 'generate')
+        return main.handle_generate_response(response)
+    except Exception as e:
+        logs.warning('upstream_call_failed', api='generate', error=str(e))
+        raise
+
+
+async def run_pipeline(image):
+    # main.run_pipeline の非同期版
+    if main.PIPELINE_MODE == 'single':
+        result = main.parse_single_result(await call_analyze_api(image))
+        if result is not None:
+            return result
+
+    vision_response = await call_vision_api(image)
+    if isinstance(vision_response, tuple):
+        return vision_response
+    with logs.stage('local_estimate'):
+        result = main.estimate_locally(vision_response)
+    if result is not None:
+        return result
+    return main.parse_generate_result(await call_generate_api(vision_response))
+
+
+async def analyze_uncached(cache_key, image_signature, image):
+    # main.analyze_uncached の非同期版
+    cached = await asyncio.to_thread(main.result_cache.get, cache_key)
+    if cached is not None:
+        return cached
+
+    with logs.stage('preprocess'):
+        prepared = await asyncio.to_thread(main.prepare_image, image)
+    result = await run_pipeline(prepared)
+    if not isinstance(result, tuple):
+        await asyncio.to_thread(main.store_result, cache_key, image_signature, result)
+    return result
+
+
+async def analyze_image(image):
+    # キャッシュの確認や画像の縮小はCPU・ディスクを使うのでスレッドで行う
+    metrics.image_bytes.observe(image.size)
+    with logs.stage('cache'):
+        cache_key, image_signature, cached, cache_status = await asyncio.to_thread(
+            main.lookup_cached_result, image)
+    if cached is not None:
+        return 200, cached, cache_status
+
+    result, shared = await inflight.do(cache_key, analyze_uncached, cache_key, image_signature, image)
+    if isinstance(result, tuple):
+        error_body, status_code = result
+        return status_code, error_body, None
+    return 200, result, 'COALESCED' if shared else cache_status
+
+
+def get_header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+async def read_body(receive, limit):
+    body = bytearray()
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > limit:
+            return None
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_json(send, status, body, headers=None):
+    data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+    response_headers = [
+        (b'content-type', b'application/json; charset=utf-8'),
+        (b'content-length', str(len(data)).encode('latin-1')),
+    ]
+    for name, value in (headers or {}).items():
+        response_headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': data})
+
+
+async def analyze(scope, receive, send):
+    with logs.timed_request() as timings:
+        status, cache_status = await analyze_request(scope, receive, send)
+        logs.log_request('analyze', timings, status=status, cache=cache_status)
+        metrics.observe_request('analyze', status, timings, cache_status)
+
+
+def load_image(content_type, body):
+    if content_type in main.RAW_UPLOAD_TYPES:
+        return ImageData.from_bytes(bytes(body))
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or 'image' not in data:
+        raise ValueError('画像データが含まれていません')
+    return ImageData.from_data_url(data['image'])
+
+
+async def analyze_request(scope, receive, send):
+    content_type = get_header(scope, b'content-type').split(';')[0].strip().lower()
+    try:
+        with logs.stage('decode'):
+            body = await read_body(receive, main.app.config['MAX_CONTENT_LENGTH'])
+            if body is None:
+                await send_json(send, 413, {'error': 'リクエストのサイズが大きすぎます'})
+                return 413, None
+
+            # 画像データを取得
+            try:
+                image = load_image(content_type, body)
+            except ValueError as e:
+                # 画像データの誤りはクライアント側のエラー
+                await send_json(send, 400, {'error': str(e)})
+                return 400, None
+
+        status, result, cache_status = await analyze_image(image)
+        headers = {'X-Cache': cache_status} if cache_status else None
+        with logs.stage('serialize'):
+            await send_json(send, status, result, headers)
+        return status, cache_status
+    except asyncio.TimeoutError as e:
+        await send_json(send, 504, {'error': f'Gemini APIの応答がタイムアウトしました: {str(e)}'})
+        return 504, None
+    except RateLimitExceeded as e:
+        await send_json(send, 503, {'error': main.RATE_LIMITED_MESSAGE},
+                        {'Retry-After': main.retry_after_header(e.retry_after)})
+        return 503, None
+    except Exception as e:
+        logs.error('analyze_failed', error=str(e))
+        await send_json(send, 500, {'error': str(e)})
+        return 500, None
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await upstream_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def wants_async(scope):
+    # main.wants_async と同じ判定（ジョブキューはFlaskアプリ側にある）
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    if query.get('async', [''])[-1] in ('1', 'true'):
+        return True
+    return 'respond-async' in get_header(scope, b'prefer')
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if (scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/analyze'
+            and get_header(scope, b'content-type').split(';')[0].strip().lower() != 'multipart/form-data'
+            and not wants_async(scope)):
+        await analyze(scope, receive, send)
+        return
+
+    # multipart・非同期ジョブや他のルートは同期のFlaskアプリをスレッドプールで処理する
+    await flask_app(scope, receive, send)
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+import logs
+
+# Gemini API用のスコープ
+SCOPES = (
+    'https://www.googleapis.com/auth/cloud-platform',
+    'https://www.googleapis.com/auth/generative-language',
+)
+
+# 有効期限のこの秒数前にトークンを更新する
+REFRESH_MARGIN = 300
+# 更新に失敗した場合の再試行間隔（秒）
+RETRY_INTERVAL = 30
+
+
+class CredentialProvider:
+    """サービスアカウントの認証情報をプロセス全体で共有し、バックグラウンドで更新する"""
+
+    def __init__(self, env_name='GOOGLE_SERVICE_ACCOUNT_INFO', scopes=SCOPES,
+                 refresh_margin=REFRESH_MARGIN):
+        self.env_name = env_name
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self.refresh_count = 0
+        self.cache_hits = 0
+        self._credentials = None
+        # _lock は認証情報の参照と差し替えだけ、_refresh_lock は更新の通信を1つにまとめるために使う
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _build(self):
+        # google-authとrequestsは読み込みが重いので、最初にトークンが必要になるまで読み込まない
+        from google.oauth2 import service_account
+
+        service_account_info = os.getenv(self.env_name)
+        if not service_account_info:
+            raise ValueError(f'{self.env_name}環境変数が設定されていません')
+
+        credentials_dict = json.loads(service_account_info)
+        return service_account.Credentials.from_service_account_info(
+            credentials_dict, scopes=self.scopes)
+
+    def _refresh(self):
+        # 通信中もロックを持たずに古いトークンを返せるよう、別に作った認証情報を更新してから差し替える
+        from google.auth.transport.requests import Request
+
+        with self._refresh_lock:
+            # 待っている間に他のスレッドが更新していればそれを使う
+            with self._lock:
+                if self._seconds_until_refresh() > 0:
+                    return self._credentials.token
+            credentials = self._build()
+            credentials.refresh(Request())
+            with self._lock:
+                self._credentials = credentials
+                self.refresh_count += 1
+            if self._thread is None:
+                self._start_refresher()
+            return credentials.token
+
+    def _seconds_until_refresh(self, margin=None):
+        # ロックを保持した状態で呼び出すこと
+        if margin is None:
+            margin = self.refresh_margin
+        if self._credentials is None:
+            return 0
+        expiry = self._credentials.expiry
+        if expiry is None or not self._credentials.token:
+            return 0
+        # google-authのexpiryはタイムゾーンなしのUTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds() - margin
+
+    def _cached_token(self):
+        # 有効なトークンがあれば返す。他のスレッドが更新中なら、期限が切れるまでは今のトークンを使う
+        margin = 0 if self._refresh_lock.locked() else self.refresh_margin
+        with self._lock:
+            if self._seconds_until_refresh(margin) > 0:
+                self.cache_hits += 1
+                return self._credentials.token
+        return None
+
+    def get_token(self):
+        token = self._cached_token()
+        if token is not None:
+            return token
+        # 初回やバックグラウンド更新が間に合わなかった場合は同期的に更新
+        return self._refresh()
+
+    async def get_token_async(self):
+        # 有効なトークンがあればイベントループを止めずにそのまま返す
+        token = self._cached_token()
+        if token is not None:
+            return token
+        # 初回の作成や更新はネットワーク通信を伴うのでスレッドで行う
+        return await asyncio.to_thread(self.get_token)
+
+    def _start_refresher(self):
+        self._thread = threading.Thread(
+            target=self._run, name='credential-refresher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                wait = max(self._seconds_until_refresh(), 0)
+            if self._stop.wait(wait):
+                return
+            try:
+                self._refresh()
+            except Exception as e:
+                logs.error('token_refresh_failed', error=str(e))
+                if self._stop.wait(RETRY_INTERVAL):
+                    return
+
+    def stats(self):
+        with self._lock:
+            return {
+                'refreshes': self.refresh_count,
+                'cache_hits': self.cache_hits,
+            }
+
+    def stop(self):
+        self._stop.set()
+
+
+class StaticTokenProvider:
+    """固定トークンを返す（ローカルのスタブサーバー向け）"""
+
+    def __init__(self, token):
+        self.token = token
+        self.refresh_count = 0
+        self.cache_hits = 0
+
+    def get_token(self):
+        self.cache_hits += 1
+        return self.token
+
+    async def get_token_async(self):
+        return self.get_token()
+
+    def stats(self):
+        return {'refreshes': 0, 'cache_hits': self.cache_hits}
+
+    def stop(self):
+        pass
+
+
+def make_credential_provider():
+    static_token = os.getenv('GEMINI_STATIC_TOKEN')
+    if static_token:
+        return StaticTokenProvider(static_token)
+    return CredentialProvider()
+
+
+credential_provider = make_credential_provider()
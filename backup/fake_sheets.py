@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# ローカル検証用のGoogle Sheets APIスタブサーバー
+#
+#   python backup/fake_sheets.py --port 8002 --latency 0.1
+#   SHEETS_API_ROOT=http://127.0.0.1:8002/ python backup/test_all.py
+#
+# values:batchGet と、それをまとめたバッチリクエスト（POST /batch）だけに対応する
+import argparse
+import json
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from sheets_client import GEKO_RANGE, KYUSHOKU_RANGE, REMIND_RANGE
+
+BATCH_GET_PATH = re.compile(r'^/v4/spreadsheets/(?P<spreadsheet_id>[^/]+)/values:batchGet$')
+A1_RANGE = re.compile(r'^(?:[^!]+!)?([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$')
+
+
+def default_sheets():
+    # 今日の日付の行を含む給食・下校時間の表と、A2にリマインドがある表
+    today = datetime.now(timezone(timedelta(hours=9))).strftime('%Y/%m/%d')
+    return {
+        KYUSHOKU_RANGE[0]: [['日付', '献立'], ['2024/01/01', 'カレーライス'], [today, 'クリームシチューとコッペパン']],
+        GEKO_RANGE[0]: [['日付', '下校時間'], [today, '14:30']],
+        REMIND_RANGE[0]: [['リマインド'], ['図工の作品を持っていくだぴょん']],
+    }
+
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def read_range(rows, range_name):
+    # A1形式の範囲（A:B, A2, A1:B3 など）の値を返す
+    match = A1_RANGE.match(range_name)
+    if not match:
+        raise ValueError(f'Unable to parse range: {range_name}')
+    start_col, start_row, end_col, end_row = match.groups()
+    end_col = end_col or start_col
+    if end_row is None:
+        # 終わりの列がない場合は1つのセル
+        end_row = start_row
+    first = int(start_row) - 1 if start_row else 0
+    last = int(end_row) if end_row else len(rows)
+    values = []
+    for row in rows[first:last]:
+        values.append(row[column_index(start_col):column_index(end_col) + 1])
+    # 実際のAPIと同じく、末尾の空の行は返さない
+    while values and not values[-1]:
+        values.pop()
+    return {'range': range_name, 'majorDimension': 'ROWS', 'values': values}
+
+
+class FakeSheets:
+    def __init__(self, sheets=None, latency=0.0):
+        self.sheets = sheets or default_sheets()
+        self.latency = latency
+        self.lock = threading.Lock()
+        # HTTPリクエスト数と、バッチの中身も含めた values:batchGet の呼び出し数
+        self.requests = 0
+        self.batch_gets = 0
+
+    def record(self, batch_gets):
+        with self.lock:
+            self.requests += 1
+            self.batch_gets += batch_gets
+
+    def batch_get(self, path):
+        # (ステータスコード, 本文) を返す
+        url = urlsplit(path)
+        match = BATCH_GET_PATH.match(url.path)
+        if not match:
+            return 404, {'error': {'code': 404, 'status': 'NOT_FOUND', 'message': url.path}}
+        rows = self.sheets.get(match.group('spreadsheet_id'))
+        if rows is None:
+            return 404, {'error': {'code': 404, 'status': 'NOT_FOUND',
+                                   'message': 'Requested entity was not found.'}}
+        try:
+            value_ranges = [read_range(rows, name) for name in parse_qs(url.query).get('ranges', [])]
+        except ValueError as e:
+            return 400, {'error': {'code': 400, 'status': 'INVALID_ARGUMENT', 'message': str(e)}}
+        return 200, {'spreadsheetId': match.group('spreadsheet_id'), 'valueRanges': value_ranges}
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'batch_gets': self.batch_gets}
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.batch_gets = 0
+
+
+class FakeSheetsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, status, content_type, data):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_json(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_body(status, 'application/json; charset=UTF-8', data)
+
+        def do_GET(self):
+            if self.path == '/_stats':
+                self.send_json(200, fake.stats())
+                return
+            fake.record(1)
+            if fake.latency:
+                time.sleep(fake.latency)
+            self.send_json(*fake.batch_get(self.path))
+
+        def do_POST(self):
+            if urlsplit(self.path).path != '/batch':
+                self.send_json(404, {'error': {'code': 404, 'status': 'NOT_FOUND', 'message': self.path}})
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            message = BytesParser(policy=HTTP).parsebytes(
+                f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('latin-1')
+                + self.rfile.read(length))
+            if not message.is_multipart():
+                self.send_json(400, {'error': {'code': 400, 'status': 'INVALID_ARGUMENT',
+                                               'message': 'multipart/mixed required'}})
+                return
+
+            parts = message.get_payload()
+            fake.record(len(parts))
+            if fake.latency:
+                time.sleep(fake.latency)
+
+            # 各パートは "GET /v4/... HTTP/1.1" で始まるHTTPリクエスト
+            boundary = 'batch_fake_sheets'
+            body = []
+            for part in parts:
+                request_line = part.get_payload().split('\n', 1)[0].strip()
+                status, result = fake.batch_get(request_line.split(' ')[1])
+                content_id = part['Content-ID'].strip('<>')
+                body.append(
+                    f'--{boundary}\r\n'
+                    'Content-Type: application/http\r\n'
+                    f'Content-ID: <response-{content_id}>\r\n\r\n'
+                    f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                    'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+                    f'{json.dumps(result, ensure_ascii=False)}\r\n')
+            body.append(f'--{boundary}--\r\n')
+            self.send_body(200, f'multipart/mixed; boundary={boundary}', ''.join(body).encode('utf-8'))
+
+    return Handler
+
+
+def start_server(fake=None, host='127.0.0.1', port=0):
+    # テストやベンチマークから使う場合はスレッドで起動する
+    fake = fake or FakeSheets()
+    server = FakeSheetsServer((host, port), make_handler(fake))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    api_root = f'http://{host}:{server.server_address[1]}/'
+    return server, api_root
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Google Sheets APIスタブサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8002)
+    parser.add_argument('--latency', type=float, default=0.0, help='応答までの遅延（秒）')
+    args = parser.parse_args()
+
+    server = FakeSheetsServer((args.host, args.port), make_handler(FakeSheets(latency=args.latency)))
+    print(f"Sheets APIスタブ: http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
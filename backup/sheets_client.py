@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# 朝のメッセージ用のGoogleスプレッドシートを読む共有クライアント
+#
+# 給食・下校時間・リマインドのスプレッドシートを、スプレッドシートごとの values().batchGet を
+# 1つのHTTPバッチリクエストにまとめて読む。ローカルのスタブに向ける場合:
+#
+#   python backup/fake_sheets.py --port 8002
+#   SHEETS_API_ROOT=http://127.0.0.1:8002/ python backup/test_all.py
+import json
+import os
+import threading
+import time
+
+# (スプレッドシートID, 範囲)
+KYUSHOKU_RANGE = ('1VgVASBlOmjK_VLbsbgAGn0wu6Oi5CRiUJXfVZ8zhOpY', 'A:B')
+GEKO_RANGE = ('18LOXzRjakazyQ5SB_yLHfZhZOBTIqp2E_am9gNrIJOQ', 'A:B')
+REMIND_RANGE = ('1QOjCLGUat3G6n3LlaY8iKr9Eu93AEkimNuPUqwFPJoI', 'A2')
+MORNING_RANGES = (KYUSHOKU_RANGE, GEKO_RANGE, REMIND_RANGE)
+
+DEFAULT_API_ROOT = 'https://sheets.googleapis.com/'
+# 同じ朝のうちに何度実行してもスプレッドシートを読み直さない
+DEFAULT_TTL = 300
+
+
+class SheetsClient:
+    """Sheets APIのサービスを1度だけ作り、読んだ範囲をTTL付きでキャッシュする
+
+    ディスカバリー文書はgoogle-api-python-clientに同梱のものを使うので、作成時に通信しない。
+    """
+
+    def __init__(self, env_name='GOOGLE_SERVICE_ACCOUNT_INFO', api_root=None, ttl=DEFAULT_TTL):
+        self.env_name = env_name
+        self.api_root = api_root
+        self.ttl = ttl
+        # Sheets APIへのHTTPリクエスト数（バッチは1回と数える）
+        self.round_trips = 0
+        self._service = None
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @property
+    def root_url(self):
+        root = self.api_root or DEFAULT_API_ROOT
+        return root if root.endswith('/') else root + '/'
+
+    def _credentials(self):
+        service_account_info = os.getenv(self.env_name)
+        if not service_account_info:
+            if self.api_root:
+                # ローカルのスタブは認証しない
+                from google.auth.credentials import AnonymousCredentials
+
+                return AnonymousCredentials()
+            raise ValueError(f'{self.env_name} environment variable not set')
+
+        from google.oauth2 import service_account
+
+        return service_account.Credentials.from_service_account_info(json.loads(service_account_info))
+
+    def _build(self):
+        from googleapiclient.discovery import build
+
+        options = {'api_endpoint': self.root_url} if self.api_root else None
+        return build('sheets', 'v4', credentials=self._credentials(), static_discovery=True,
+                     cache_discovery=False, client_options=options)
+
+    @property
+    def service(self):
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    self._service = self._build()
+        return self._service
+
+    def get_values(self, spreadsheet_id, range_name):
+        key = (spreadsheet_id, range_name)
+        return self.get_ranges([key])[key]
+
+    def get_ranges(self, ranges):
+        # (スプレッドシートID, 範囲) ごとの値を返す。キャッシュにない範囲だけまとめて読む
+        now = time.monotonic()
+        results = {}
+        missing = {}
+        for key in dict.fromkeys(ranges):
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > now:
+                results[key] = cached[1]
+            else:
+                missing.setdefault(key[0], []).append(key[1])
+
+        if missing:
+            fetched, errors = self._fetch(missing)
+            expires_at = time.monotonic() + self.ttl
+            for key, values in fetched.items():
+                self._cache[key] = (expires_at, values)
+            results.update(fetched)
+            # 読めた範囲はキャッシュしてから、失敗したものを知らせる
+            if errors:
+                raise errors[0]
+        return results
+
+    def _fetch(self, missing):
+        # スプレッドシートごとの values().batchGet を1回のHTTPリクエストにまとめる
+        from googleapiclient.http import BatchHttpRequest
+
+        values = self.service.spreadsheets().values()
+        fetched = {}
+        errors = []
+
+        def collect(spreadsheet_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+                return
+            # valueRanges は指定した順に返る（range は "シート1!A1:B100" のように正規化される）
+            value_ranges = response.get('valueRanges', [])
+            for index, range_name in enumerate(missing[spreadsheet_id]):
+                value_range = value_ranges[index] if index < len(value_ranges) else {}
+                fetched[(spreadsheet_id, range_name)] = value_range.get('values', [])
+
+        self.round_trips += 1
+        if len(missing) == 1:
+            spreadsheet_id, range_names = next(iter(missing.items()))
+            try:
+                response = values.batchGet(spreadsheetId=spreadsheet_id, ranges=range_names).execute()
+            except Exception as e:
+                collect(spreadsheet_id, None, e)
+            else:
+                collect(spreadsheet_id, response, None)
+            return fetched, errors
+
+        # service.new_batch_http_request() はSHEETS_API_ROOTを無視するのでURLを指定して作る
+        batch = BatchHttpRequest(callback=collect, batch_uri=self.root_url + 'batch')
+        for spreadsheet_id, range_names in missing.items():
+            batch.add(values.batchGet(spreadsheetId=spreadsheet_id, ranges=range_names),
+                      request_id=spreadsheet_id)
+        batch.execute()
+        return fetched, errors
+
+    def clear(self):
+        self._cache.clear()
+
+
+def make_sheets_client():
+    return SheetsClient(api_root=os.getenv('SHEETS_API_ROOT') or None,
+                        ttl=float(os.getenv('SHEETS_CACHE_TTL', DEFAULT_TTL)))
+
+
+sheets_client = make_sheets_client()
@@ -1,8 +1,6 @@
 # -*- coding: utf-8 -*-
 import sys
 import io
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 import os
 import sys
 import io
@@ -10,16 +8,19 @@ from datetime import datetime
 from dateutil.parser import parse as date_parse
 from dateutil import tz
 from dotenv import load_dotenv
-import json
 
 # 環境変数の読み込み
 load_dotenv()
 
+# .env の SHEETS_API_ROOT などを使うので load_dotenv の後で読み込む
+from sheets_client import GEKO_RANGE, KYUSHOKU_RANGE, MORNING_RANGES, REMIND_RANGE, sheets_client
 
-
-import requests
+# google.generativeai は読み込みに時間がかかるので、使う関数の中で読み込む
+# （Sheets APIのクライアントも sheets_client の中で最初に使うときに読み込む）
 
 def get_weather():
+    import requests
+
     try:
         # OpenWeatherMap APIのエンドポイントとパラメータ
         url = "https://api.openweathermap.org/data/2.5/forecast"
@@ -113,113 +114,41 @@ def get_weather():
         print(f"天気情報取得エラー: {str(e)}")
         return f"天気情報の取得に失敗しました（エラー: {str(e)}）"
 
+def find_today_value(values):
+    # A列の日付が今日の行のB列を返す
+    # 日本時間（JST）で現在の日付を取得
+    jst = tz.gettz('Asia/Tokyo')
+    today = datetime.now(jst).strftime('%Y/%m/%d')
+    for row in values:
+        if len(row) >= 2:
+            try:
+                # 日本時間としてパース
+                sheet_date = date_parse(row[0], tzinfos={'JST': 9 * 3600}).strftime('%Y/%m/%d')
+                if sheet_date == today:
+                    return row[1]
+            except ValueError:
+                continue
+    return ""
+
 def get_kyushoku():
     try:
-        # サービスアカウント情報を環境変数から取得
-        service_account_info = os.getenv('GOOGLE_SERVICE_ACCOUNT_INFO')
-        if not service_account_info:
-            raise ValueError("GOOGLE_SERVICE_ACCOUNT_INFO environment variable not set")
-            
-        # JSON文字列を辞書に変換
-        credentials_dict = json.loads(service_account_info)
-        
-        # クレデンシャルを作成
-        credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-        service = build('sheets', 'v4', credentials=credentials)
-        SPREADSHEET_ID = '1VgVASBlOmjK_VLbsbgAGn0wu6Oi5CRiUJXfVZ8zhOpY'
-        
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='A:B'
-        ).execute()
-        
-        values = result.get('values', [])
-        
-        if not values:
-            return ""
-            
-        # 日本時間（JST）で現在の日付を取得
-        jst = tz.gettz('Asia/Tokyo')
-        today = datetime.now(jst).strftime('%Y/%m/%d')
-        found = False
-        for row in values:
-            if len(row) >= 2:
-                try:
-                    # 日本時間としてパース
-                    sheet_date = date_parse(row[0], tzinfos={'JST': 9 * 3600}).strftime('%Y/%m/%d')
-                    if sheet_date == today:
-                        return row[1]
-                except ValueError:
-                    continue
-        return ""
+        values = sheets_client.get_values(*KYUSHOKU_RANGE)
+        return find_today_value(values)
     except Exception as e:
         print(f"給食データ取得エラー: {str(e)}")
         return ""
 
 def get_geko():
     try:
-        # サービスアカウント情報を環境変数から取得
-        service_account_info = os.getenv('GOOGLE_SERVICE_ACCOUNT_INFO')
-        if not service_account_info:
-            raise ValueError("GOOGLE_SERVICE_ACCOUNT_INFO environment variable not set")
-            
-        # JSON文字列を辞書に変換
-        credentials_dict = json.loads(service_account_info)
-        
-        # クレデンシャルを作成
-        credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-        service = build('sheets', 'v4', credentials=credentials)
-        SPREADSHEET_ID = '18LOXzRjakazyQ5SB_yLHfZhZOBTIqp2E_am9gNrIJOQ'
-        
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='A:B'
-        ).execute()
-        
-        values = result.get('values', [])
-        
-        if not values:
-            return ""
-            
-        # 日本時間（JST）で現在の日付を取得
-        jst = tz.gettz('Asia/Tokyo')
-        today = datetime.now(jst).strftime('%Y/%m/%d')
-        found = False
-        for row in values:
-            if len(row) >= 2:
-                try:
-                    # 日本時間としてパース
-                    sheet_date = date_parse(row[0], tzinfos={'JST': 9 * 3600}).strftime('%Y/%m/%d')
-                    if sheet_date == today:
-                        return row[1]
-                except ValueError:
-                    continue
-        return ""
+        values = sheets_client.get_values(*GEKO_RANGE)
+        return find_today_value(values)
     except Exception as e:
         print(f"下校時間データ取得エラー: {str(e)}")
         return ""
 
 def get_remind():
     try:
-        # サービスアカウント情報を環境変数から取得
-        service_account_info = os.getenv('GOOGLE_SERVICE_ACCOUNT_INFO')
-        if not service_account_info:
-            raise ValueError("GOOGLE_SERVICE_ACCOUNT_INFO environment variable not set")
-            
-        # JSON文字列を辞書に変換
-        credentials_dict = json.loads(service_account_info)
-        
-        # クレデンシャルを作成
-        credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-        service = build('sheets', 'v4', credentials=credentials)
-        SPREADSHEET_ID = '1QOjCLGUat3G6n3LlaY8iKr9Eu93AEkimNuPUqwFPJoI'
-        
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='A2'
-        ).execute()
-        
-        values = result.get('values', [])
+        values = sheets_client.get_values(*REMIND_RANGE)
         if not values:
             return ""
             
@@ -228,9 +157,9 @@ def get_remind():
         print(f"リマインドデータ取得エラー: {str(e)}")
         return ""
 
-import google.generativeai as genai
-
 def generate_text():
+    import google.generativeai as genai
+
     # Google Generative AI APIの設定
     genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
     
@@ -239,6 +168,11 @@ def generate_text():
     print(f"\n=== 使用モデル: gemini-1.5-flash ===")
     
     # 情報の取得
+    # 3つのスプレッドシートを1回のリクエストでまとめて読んでおく（失敗した分は個別に読み直す）
+    try:
+        sheets_client.get_ranges(MORNING_RANGES)
+    except Exception as e:
+        print(f"スプレッドシート一括取得エラー: {str(e)}")
     weather = get_weather()
     kyushoku = get_kyushoku()
     geko = get_geko()
@@ -0,0 +1,1343 @@
+# -*- coding: utf-8 -*-
+# 性能計測用スクリプト（pip install -r requirements-dev.txt）
+#
+#   python benchmark.py phash --entries 300000 --queries 20000
+#   python benchmark.py preprocess --max-edge 1024 --quality 80
+#   python benchmark.py parser --responses 100000
+#   python benchmark.py logging --requests 100000
+#   python benchmark.py metrics --requests 100000 --threads 1 4
+#   python benchmark.py loadtest --concurrency 200 --requests 1000 --routes analyze stream
+#   python benchmark.py batch --images 32 --concurrency 1 2 4 8
+#   python benchmark.py coalesce --duplicates 20 --rounds 5
+#   python benchmark.py ratelimit --quota 20 --requests 300
+#   python benchmark.py stream --requests 20 --chunk-delay 0.05
+#   python benchmark.py caloriedb --repeat 100000
+#   python benchmark.py jobs --jobs 40 --workers 1 4 8 --backends memory sqlite
+#   python benchmark.py importtime --repeat 5
+#   python benchmark.py sheets --latency 0.1 --repeat 5
+#   python benchmark.py replay --requests 200 --concurrency 8 --output replay.json [--baseline old.json]
+import argparse
+import json
+import random
+import time
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(int(len(values) * p / 100), len(values) - 1)
+    return values[index]
+
+
+def summarize_latencies(latencies):
+    # 秒単位の計測値をマイクロ秒・ミリ秒の要約にする
+    return {
+        'count': len(latencies),
+        'mean_us': sum(latencies) / len(latencies) * 1e6 if latencies else 0.0,
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+        'max_us': max(latencies) * 1e6 if latencies else 0.0,
+    }
+
+
+def print_result(name, result, output=None):
+    print(f"\n=== {name} ===")
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+def bench_phash(args):
+    from phash import HASH_BITS, HashIndex
+
+    rng = random.Random(args.seed)
+    index = HashIndex(chunks=args.chunks)
+
+    hashes = [rng.getrandbits(HASH_BITS) for _ in range(args.entries)]
+    start = time.perf_counter()
+    for i, value in enumerate(hashes):
+        index.add(value, i)
+    build_seconds = time.perf_counter() - start
+
+    # 半分は登録済みハッシュの数ビットを反転させた近似重複、残りは無関係なハッシュ
+    queries = []
+    for _ in range(args.queries):
+        if rng.random() < 0.5:
+            value = rng.choice(hashes)
+            for bit in rng.sample(range(HASH_BITS), rng.randint(0, args.distance)):
+                value ^= 1 << bit
+            queries.append((value, True))
+        else:
+            queries.append((rng.getrandbits(HASH_BITS), False))
+
+    latencies = []
+    found = 0
+    missed = 0
+    for value, expected in queries:
+        start = time.perf_counter()
+        match = index.search(value, args.distance)
+        latencies.append(time.perf_counter() - start)
+        if match is not None:
+            found += 1
+        elif expected:
+            missed += 1
+
+    result = {
+        'entries': args.entries,
+        'chunks': args.chunks,
+        'max_distance': args.distance,
+        'build_seconds': build_seconds,
+        'found': found,
+        'missed_near_duplicates': missed,
+        'lookup': summarize_latencies(latencies),
+    }
+    print_result('近似重複インデックス', result, args.output)
+
+
+def make_test_image(width, height, seed=0, quality=92):
+    # カメラ画像に近いサイズになるよう、グラデーションにノイズを重ねたJPEGを作る
+    import io
+
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([
+        (x * 255 // max(width - 1, 1)),
+        (y * 255 // max(height - 1, 1)),
+        ((x + y) * 127 // max(width + height - 2, 1)),
+    ], axis=-1)
+    noise = rng.normal(0, 12, size=(height, width, 3))
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def bench_preprocess(args):
+    from preprocess import downscale_image
+
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes]
+    results = []
+    for width, height in sizes:
+        raw = make_test_image(width, height)
+        durations = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            data, _ = downscale_image(raw, args.max_edge, args.quality)
+            durations.append(time.perf_counter() - start)
+        mean_ms = sum(durations) / len(durations) * 1000
+        results.append({
+            'size': f'{width}x{height}',
+            'input_bytes': len(raw),
+            'output_bytes': len(data),
+            'saved_bytes': len(raw) - len(data),
+            # Base64にするとさらに4/3倍になる
+            'saved_payload_bytes': (len(raw) - len(data)) * 4 // 3,
+            'mean_ms': mean_ms,
+            'p99_ms': percentile(durations, 99) * 1000,
+        })
+
+    print_result('画像の縮小・再圧縮', {
+        'max_edge': args.max_edge,
+        'quality': args.quality,
+        'images': results,
+    }, args.output)
+
+
+def make_recorded_responses(count, seed=0):
+    # 実際のGeminiレスポンスと同じ形の封筒に、料理数や書式の異なる分析結果を入れる
+    from fake_gemini import make_response
+
+    rng = random.Random(seed)
+    names = ['白ご飯', '味噌汁', '鶏の唐揚げ', 'サラダ', '焼き魚', '卵焼き', '肉じゃが', 'ひじきの煮物']
+    methods = ['炊飯', '煮る', '揚げる', '焼く', '生', '炒める']
+    responses = []
+    for i in range(count):
+        dishes = [
+            {
+                'name': rng.choice(names),
+                'kcal': rng.randint(20, 600),
+                'cooking_method': rng.choice(methods),
+                'portion': f'{rng.randint(1, 3)}人前',
+            }
+            for _ in range(rng.randint(1, 8))
+        ]
+        result = json.dumps({'dishes': dishes, 'total_kcal': sum(d['kcal'] for d in dishes)}, ensure_ascii=False)
+        if i % 3 == 1:
+            result = f'分析結果です。\n```json\n{result}\n```'
+        elif i % 3 == 2:
+            result = f'以下が推定結果です：{result}\n以上です。'
+        responses.append(make_response(result))
+    return responses
+
+
+def bench_parser(args):
+    from schema import parse_response
+
+    responses = make_recorded_responses(args.responses, args.seed)
+    raw_bytes = sum(len(json.dumps(r, ensure_ascii=False).encode('utf-8')) for r in responses)
+
+    durations = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        parsed = [parse_response(response) for response in responses]
+        durations.append(time.perf_counter() - start)
+    best = min(durations)
+    compact_bytes = sum(len(json.dumps(p.to_dict(), ensure_ascii=False).encode('utf-8')) for p in parsed)
+
+    print_result('分析結果パーサー', {
+        'responses': args.responses,
+        'best_seconds': best,
+        'per_response_us': best / args.responses * 1e6,
+        'responses_per_second': args.responses / best,
+        'mean_upstream_bytes': raw_bytes / args.responses,
+        'mean_result_bytes': compact_bytes / args.responses,
+    }, args.output)
+
+
+def bench_logging(args):
+    import contextlib
+    import os
+
+    import logs
+
+    devnull = open(os.devnull, 'w')
+    headers = {'Content-Type': 'application/json; charset=UTF-8', 'Vary': 'Origin', 'Server': 'scaffolding on HTTPServer2'}
+
+    def old_prints():
+        # 以前の call_vision_api / call_generate_api 相当の print
+        with contextlib.redirect_stdout(devnull):
+            for api in ('Vision', 'Generate'):
+                print(f"=== {api} APIリクエスト詳細 ===")
+                print(f"Base64データサイズ: {100000}バイト")
+                print(f"=== APIレスポンス ===")
+                print(f"ステータスコード: {200}")
+                print(f"レスポンスヘッダー: {dict(headers)}")
+
+    def new_logging(logger_fields):
+        with logs.timed_request() as timings:
+            for name in ('decode', 'credentials', 'vision', 'generate', 'serialize'):
+                with logs.stage(name):
+                    pass
+            logs.log_request('analyze', timings, **logger_fields)
+
+    results = {}
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        old_prints()
+    results['print'] = (time.perf_counter() - start) / args.requests * 1e6
+
+    for rate in args.sample_rates:
+        # ベンチマーク用のロガーに差し替える
+        original = logs.structured_logger
+        logs.structured_logger = logs.setup_logging(
+            name='calcam.benchmark', stream=devnull, sample_rate=rate, queue_size=args.requests + 1)
+        try:
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                new_logging({'status': 200, 'cache': 'MISS', 'request_bytes': 100000})
+            results[f'structured_sample_{rate}'] = (time.perf_counter() - start) / args.requests * 1e6
+        finally:
+            logs.structured_logger.stop()
+            logs.structured_logger = original
+
+    print_result('ログ出力のオーバーヘッド（1リクエストあたりのμs）', {
+        'requests': args.requests,
+        'per_request_us': results,
+    }, args.output)
+
+
+def bench_metrics(args):
+    import threading
+
+    import logs
+    import metrics
+
+    def record(count):
+        for _ in range(count):
+            with logs.timed_request() as timings:
+                for name in ('decode', 'cache', 'preprocess', 'credentials', 'analyze', 'serialize'):
+                    with logs.stage(name):
+                        pass
+                metrics.image_bytes.observe(120000)
+                metrics.observe_request('analyze', 200, timings, 'MISS')
+
+    def timings_only(count):
+        for _ in range(count):
+            with logs.timed_request() as timings:
+                for name in ('decode', 'cache', 'preprocess', 'credentials', 'analyze', 'serialize'):
+                    with logs.stage(name):
+                        pass
+
+    start = time.perf_counter()
+    timings_only(args.requests)
+    baseline_us = (time.perf_counter() - start) / args.requests * 1e6
+
+    results = {}
+    for thread_count in args.threads:
+        per_thread = args.requests // thread_count
+        threads = [threading.Thread(target=record, args=(per_thread,)) for _ in range(thread_count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        results[f'threads_{thread_count}'] = {
+            'per_request_us': elapsed / (per_thread * thread_count) * 1e6 - baseline_us,
+        }
+
+    # 集計が記録と同じ件数になっていることを確認する
+    recorded = sum(args.requests // thread_count * thread_count for thread_count in args.threads)
+    counted = metrics.requests_total.labels('analyze', 200).value()
+
+    start = time.perf_counter()
+    for _ in range(args.scrapes):
+        body = metrics.registry.render()
+    scrape_ms = (time.perf_counter() - start) / args.scrapes * 1000
+
+    print_result('メトリクス記録のオーバーヘッド', {
+        'requests': args.requests,
+        'stage_timing_us': baseline_us,
+        'metrics': results,
+        'recorded': recorded,
+        'counted': counted,
+        'scrape_ms': scrape_ms,
+        'scrape_bytes': len(body.encode('utf-8')),
+    }, args.output)
+
+
+def find_free_port():
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30.0):
+    import socket
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'サーバーが起動しませんでした: port={port}')
+
+
+def read_peak_rss_kb(pid, field='VmHWM'):
+    # Linuxのみ。/proc から最大常駐メモリ（field='VmRSS' なら今の常駐メモリ）を読む
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # Linuxのみ。clear_refs に5を書くと、このプロセスの最大常駐メモリが今の常駐メモリに戻る
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def read_cpu_seconds(pid):
+    # Linuxのみ。/proc からユーザー・システムCPU時間の合計を読む
+    import os
+
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def start_app_server(mode, port, env):
+    import os
+    import subprocess
+    import sys
+
+    if mode == 'threaded':
+        # 現在の app.run と同じスレッド型のサーバー
+        command = [sys.executable, '-c',
+                   f'import main; main.app.run(host="127.0.0.1", port={port}, threaded=True)']
+    elif mode == 'async':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1',
+                   '--port', str(port), '--log-level', 'warning', '--no-access-log']
+    else:
+        raise ValueError(f'不明なモードです: {mode}')
+
+    return subprocess.Popen(
+        command, cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, **env},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def run_load(url, body, content_type, concurrency, total):
+    import asyncio
+
+    import aiohttp
+
+    latencies = []
+    statuses = {}
+    remaining = iter(range(total))
+
+    async def worker(session):
+        for index in remaining:
+            # 一覧を渡した場合はリクエストごとに別の本文を送る
+            data = body[index % len(body)] if isinstance(body, list) else body
+            start = time.perf_counter()
+            try:
+                async with session.post(url, data=data, headers={'Content-Type': content_type}) as response:
+                    await response.read()
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=120)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'elapsed_seconds': elapsed,
+        'throughput_rps': total / elapsed,
+        'statuses': statuses,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': max(latencies) * 1000,
+        },
+    }
+
+
+def unique_bodies(image, count):
+    # JPEGの終端の後ろに番号を付けると、画像としては同じままダイジェストだけが変わる
+    return [image + index.to_bytes(4, 'big') for index in range(count)]
+
+
+def bench_loadtest(args):
+    import asyncio
+
+    from fake_gemini import FakeGemini, start_server
+
+    fake = FakeGemini(latency=args.upstream_latency)
+    fake_server, base_url = start_server(fake)
+    env = {
+        'GEMINI_API_BASE': base_url,
+        'GEMINI_STATIC_TOKEN': 'loadtest',
+        # 上流の待ち時間だけを比較するためキャッシュと縮小は無効にする
+        'RESULT_CACHE_BACKEND': 'none',
+        'NEAR_DUPLICATE_DISTANCE': '-1',
+        'PREPROCESS_MAX_EDGE': '0',
+        'UPSTREAM_RATE_LIMIT': '0',
+        'UPSTREAM_MAX_CONCURRENCY': str(args.upstream_concurrency),
+        'UPSTREAM_POOL_MAXSIZE': str(args.upstream_concurrency),
+    }
+    # 同じ画像だと同時リクエストが1回の呼び出しにまとめられるので、画像ごとに中身を変える
+    bodies = unique_bodies(make_test_image(640, 480), args.requests)
+
+    # /analyze/stream はasyncモードでもFlaskに委譲されるので、同時に処理できているかも確認する
+    paths = {'analyze': '/analyze', 'stream': '/analyze/stream'}
+    results = {}
+    try:
+        for mode in args.modes:
+            port = find_free_port()
+            process = start_app_server(mode, port, env)
+            try:
+                wait_for_port(port)
+                for route in args.routes:
+                    fake.reset()
+                    stats = asyncio.run(run_load(
+                        f'http://127.0.0.1:{port}{paths[route]}', bodies, 'image/jpeg',
+                        args.concurrency, args.requests))
+                    stats['server_peak_rss_kb'] = read_peak_rss_kb(process.pid)
+                    stats['server_cpu_seconds'] = read_cpu_seconds(process.pid)
+                    stats['upstream_calls'] = fake.stats()['total']
+                    # 上流の待ち時間が何本分重なったか（1に近ければリクエストを1件ずつ処理している）
+                    stats['effective_concurrency'] = (
+                        stats['upstream_calls'] * args.upstream_latency / stats['elapsed_seconds'])
+                    results.setdefault(mode, {})[route] = stats
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+    finally:
+        fake_server.shutdown()
+
+    print_result('負荷試験（スレッド型 vs asyncio）', {
+        'upstream_latency_seconds': args.upstream_latency,
+        'modes': results,
+    }, args.output)
+
+
+def bench_batch(args):
+    import requests
+
+    from fake_gemini import FakeGemini, start_server
+
+    fake = FakeGemini(latency=args.upstream_latency)
+    fake_server, base_url = start_server(fake)
+    # キャッシュに当たらないよう画像ごとにノイズを変える
+    images = [make_test_image(320, 240, seed=i) for i in range(args.images)]
+    files = [('images', (f'{i}.jpg', image, 'image/jpeg')) for i, image in enumerate(images)]
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            env = {
+                'GEMINI_API_BASE': base_url,
+                'GEMINI_STATIC_TOKEN': 'benchmark',
+                'RESULT_CACHE_BACKEND': 'none',
+                'NEAR_DUPLICATE_DISTANCE': '-1',
+                'UPSTREAM_RATE_LIMIT': '0',
+                'BATCH_CONCURRENCY': str(concurrency),
+            }
+            port = find_free_port()
+            process = start_app_server('threaded', port, env)
+            try:
+                wait_for_port(port)
+                fake.reset()
+                start = time.perf_counter()
+                first_result = None
+                statuses = {}
+                with requests.post(f'http://127.0.0.1:{port}/analyze/batch', files=files, stream=True) as response:
+                    for line in response.iter_lines():
+                        if not line:
+                            continue
+                        if first_result is None:
+                            first_result = time.perf_counter() - start
+                        status = str(json.loads(line)['status'])
+                        statuses[status] = statuses.get(status, 0) + 1
+                elapsed = time.perf_counter() - start
+                results.append({
+                    'concurrency': concurrency,
+                    'images': args.images,
+                    'elapsed_seconds': elapsed,
+                    'images_per_second': args.images / elapsed,
+                    'first_result_seconds': first_result,
+                    'statuses': statuses,
+                    'upstream_calls': fake.stats()['total'],
+                })
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+    finally:
+        fake_server.shutdown()
+
+    print_result('バッチ分析', {
+        'upstream_latency_seconds': args.upstream_latency,
+        'runs': results,
+    }, args.output)
+
+
+def bench_coalesce(args):
+    import asyncio
+
+    from fake_gemini import FakeGemini, start_server
+
+    fake = FakeGemini(latency=args.upstream_latency)
+    fake_server, base_url = start_server(fake)
+    env = {
+        'GEMINI_API_BASE': base_url,
+        'GEMINI_STATIC_TOKEN': 'coalesce',
+        'RESULT_CACHE_BACKEND': 'memory',
+        'NEAR_DUPLICATE_DISTANCE': '-1',
+    }
+
+    results = {}
+    try:
+        for mode in args.modes:
+            port = find_free_port()
+            process = start_app_server(mode, port, env)
+            try:
+                wait_for_port(port)
+                rounds = []
+                for round_index in range(args.rounds):
+                    # 毎回別の画像にして、前の結果がキャッシュに当たらないようにする
+                    image = make_test_image(640, 480, seed=1000 * len(results) + round_index)
+                    fake.reset()
+                    stats = asyncio.run(run_load(
+                        f'http://127.0.0.1:{port}/analyze', image, 'image/jpeg',
+                        args.duplicates, args.duplicates))
+                    rounds.append({
+                        'upstream_calls': fake.stats()['total'],
+                        'statuses': stats['statuses'],
+                        'p50_ms': stats['latency_ms']['p50'],
+                        'max_ms': stats['latency_ms']['max'],
+                    })
+                results[mode] = {
+                    'requests': args.duplicates * args.rounds,
+                    'upstream_calls': sum(item['upstream_calls'] for item in rounds),
+                    'rounds': rounds,
+                }
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+    finally:
+        fake_server.shutdown()
+
+    print_result('同一画像の同時リクエストの集約', {
+        'duplicates_per_round': args.duplicates,
+        'upstream_latency_seconds': args.upstream_latency,
+        'modes': results,
+    }, args.output)
+
+
+def bench_ratelimit(args):
+    import asyncio
+    import threading
+
+    from fake_gemini import FakeGemini, start_server
+    from ratelimit import PRIORITY_BATCH, PRIORITY_INTERACTIVE, AdaptiveRateLimiter, request_priority
+
+    fake = FakeGemini(latency=args.upstream_latency, quota=args.quota)
+    fake_server, base_url = start_server(fake)
+    bodies = unique_bodies(make_test_image(640, 480), args.requests)
+
+    results = {}
+    try:
+        for label, rate_limit in (('without_limiter', '0'), ('with_limiter', str(args.initial_rate))):
+            env = {
+                'GEMINI_API_BASE': base_url,
+                'GEMINI_STATIC_TOKEN': 'ratelimit',
+                'RESULT_CACHE_BACKEND': 'none',
+                'NEAR_DUPLICATE_DISTANCE': '-1',
+                'PREPROCESS_MAX_EDGE': '0',
+                'UPSTREAM_RATE_LIMIT': rate_limit,
+                'UPSTREAM_QUEUE_SIZE': str(args.queue_size),
+            }
+            port = find_free_port()
+            process = start_app_server(args.mode, port, env)
+            try:
+                wait_for_port(port)
+                fake.reset()
+                stats = asyncio.run(run_load(
+                    f'http://127.0.0.1:{port}/analyze', bodies, 'image/jpeg',
+                    args.concurrency, args.requests))
+                upstream = fake.stats()
+                stats['goodput_rps'] = stats['statuses'].get('200', 0) / stats['elapsed_seconds']
+                stats['upstream_calls'] = upstream['total']
+                stats['upstream_throttled'] = upstream['throttled']
+                results[label] = stats
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+    finally:
+        fake_server.shutdown()
+
+    # 優先度: バッチで列が埋まっている状態で画面からのリクエストがどれだけ待つか
+    limiter = AdaptiveRateLimiter('priority', rate=args.quota, min_rate=1, max_rate=args.quota,
+                                  burst=1, max_queue=args.batch_waiters + 100, max_wait=60)
+    waits = {PRIORITY_INTERACTIVE: [], PRIORITY_BATCH: []}
+
+    def acquire(level):
+        with request_priority(level):
+            start = time.perf_counter()
+            limiter.acquire()
+            waits[level].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=acquire, args=(PRIORITY_BATCH,)) for _ in range(args.batch_waiters)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    interactive = [threading.Thread(target=acquire, args=(PRIORITY_INTERACTIVE,)) for _ in range(10)]
+    for thread in interactive:
+        thread.start()
+    for thread in threads + interactive:
+        thread.join()
+
+    print_result('Gemini APIの割り当て超過時の挙動', {
+        'quota_per_second': args.quota,
+        'upstream_latency_seconds': args.upstream_latency,
+        'runs': results,
+        'priority_wait_ms': {
+            'interactive_p50': percentile(waits[PRIORITY_INTERACTIVE], 50) * 1000,
+            'interactive_max': max(waits[PRIORITY_INTERACTIVE]) * 1000,
+            'batch_p50': percentile(waits[PRIORITY_BATCH], 50) * 1000,
+            'batch_max': max(waits[PRIORITY_BATCH]) * 1000,
+        },
+    }, args.output)
+
+
+def bench_stream(args):
+    import requests
+
+    from fake_gemini import FakeGemini, start_server
+
+    fake = FakeGemini(latency=args.upstream_latency, chunk_chars=args.chunk_chars,
+                      chunk_delay=args.chunk_delay)
+    fake_server, base_url = start_server(fake)
+    env = {
+        'GEMINI_API_BASE': base_url,
+        'GEMINI_STATIC_TOKEN': 'stream',
+        'RESULT_CACHE_BACKEND': 'none',
+        'NEAR_DUPLICATE_DISTANCE': '-1',
+        'UPSTREAM_RATE_LIMIT': '0',
+    }
+    bodies = unique_bodies(make_test_image(640, 480), args.requests * 2)
+
+    full, first_dish, stream_total = [], [], []
+    port = find_free_port()
+    process = start_app_server('threaded', port, env)
+    try:
+        wait_for_port(port)
+        session = requests.Session()
+        headers = {'Content-Type': 'image/jpeg'}
+        for index in range(args.requests):
+            start = time.perf_counter()
+            response = session.post(f'http://127.0.0.1:{port}/analyze', data=bodies[2 * index], headers=headers)
+            response.raise_for_status()
+            full.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with session.post(f'http://127.0.0.1:{port}/analyze/stream', data=bodies[2 * index + 1],
+                              headers=headers, stream=True) as response:
+                response.raise_for_status()
+                # 開発用サーバーはチャンク転送を使わないので、1バイトずつ読んで届いた時点を測る
+                for line in response.iter_lines(chunk_size=1):
+                    if line == b'event: dish' and len(first_dish) <= index:
+                        first_dish.append(time.perf_counter() - start)
+                    elif line == b'event: total':
+                        stream_total.append(time.perf_counter() - start)
+                    elif line == b'event: error':
+                        raise RuntimeError('ストリームがエラーで終了しました')
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        fake_server.shutdown()
+
+    print_result('ストリーミングによる最初の料理までの時間', {
+        'requests': args.requests,
+        'upstream_latency_seconds': args.upstream_latency,
+        'chunk_delay_seconds': args.chunk_delay,
+        'analyze': summarize_latencies(full),
+        'stream_first_dish': summarize_latencies(first_dish),
+        'stream_total': summarize_latencies(stream_total),
+    }, args.output)
+
+
+def bench_caloriedb(args):
+    from calorie_db import CalorieDB
+
+    db = CalorieDB()
+    start = time.perf_counter()
+    entries = len(db)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    queries = {
+        'exact': [('白ご飯', '茶碗1杯'), ('味噌汁', '1杯'), ('鶏の唐揚げ', '4個')],
+        'alias': [('ゴハン', '大盛り'), ('ﾐｿｼﾙ', '2杯'), ('から揚げ（レモン添え）', '6個')],
+        'fuzzy': [('鶏肉の唐揚', '5個'), ('豚肉のしょうが焼き', '1皿'), ('醤油らーめん', '1杯')],
+        'miss': [('ガパオライス', '1皿'), ('ビビンバ', '1杯'), ('謎の料理', '')],
+    }
+    results = {}
+    for kind, items in queries.items():
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for name, portion in items:
+                entry = db.lookup(name)
+                if entry is not None:
+                    entry.scale(portion)
+        elapsed = time.perf_counter() - start
+        results[kind] = {
+            'per_lookup_us': elapsed / (args.repeat * len(items)) * 1e6,
+            'matches': {name: entry.name if entry else None
+                        for name, entry in ((name, db.lookup(name)) for name, _ in items)},
+        }
+
+    print_result('カロリー参照表の検索速度', {
+        'entries': entries,
+        'load_ms': load_ms,
+        'lookups': results,
+    }, args.output)
+
+
+def bench_jobs(args):
+    import os
+    import tempfile
+
+    import requests
+
+    from fake_gemini import FakeGemini, start_server
+
+    fake = FakeGemini(latency=args.upstream_latency)
+    fake_server, base_url = start_server(fake)
+    bodies = unique_bodies(make_test_image(320, 240), args.jobs)
+
+    results = []
+    try:
+        for backend in args.backends:
+            for workers in args.workers:
+                env = {
+                    'GEMINI_API_BASE': base_url,
+                    'GEMINI_STATIC_TOKEN': 'jobs',
+                    'RESULT_CACHE_BACKEND': 'none',
+                    'NEAR_DUPLICATE_DISTANCE': '-1',
+                    'UPSTREAM_RATE_LIMIT': '0',
+                    'JOB_BACKEND': backend,
+                    'JOB_WORKERS': str(workers),
+                    'JOB_DB_PATH': os.path.join(tempfile.mkdtemp(), 'jobs.sqlite3'),
+                }
+                port = find_free_port()
+                process = start_app_server('threaded', port, env)
+                try:
+                    wait_for_port(port)
+                    fake.reset()
+                    session = requests.Session()
+                    headers = {'Content-Type': 'image/jpeg', 'Prefer': 'respond-async'}
+                    start = time.perf_counter()
+                    enqueue_latencies, job_ids = [], []
+                    for body in bodies:
+                        request_start = time.perf_counter()
+                        response = session.post(f'http://127.0.0.1:{port}/analyze', data=body, headers=headers)
+                        enqueue_latencies.append(time.perf_counter() - request_start)
+                        if response.status_code != 202:
+                            raise RuntimeError(f'ジョブを登録できませんでした: {response.status_code}')
+                        job_ids.append(response.json()['id'])
+
+                    # 全ジョブが終わるまでポーリングする
+                    statuses = {}
+                    pending = list(job_ids)
+                    while pending:
+                        time.sleep(args.poll_interval)
+                        remaining = []
+                        for job_id in pending:
+                            job = session.get(f'http://127.0.0.1:{port}/analyze/{job_id}').json()
+                            if job['status'] in ('queued', 'running'):
+                                remaining.append(job_id)
+                            else:
+                                statuses[job['status']] = statuses.get(job['status'], 0) + 1
+                        pending = remaining
+                    elapsed = time.perf_counter() - start
+                    results.append({
+                        'backend': backend,
+                        'workers': workers,
+                        'enqueue': summarize_latencies(enqueue_latencies),
+                        'elapsed_seconds': elapsed,
+                        'jobs_per_second': args.jobs / elapsed,
+                        'statuses': statuses,
+                        'upstream_calls': fake.stats()['total'],
+                    })
+                finally:
+                    process.terminate()
+                    process.wait(timeout=10)
+    finally:
+        fake_server.shutdown()
+
+    print_result('非同期ジョブのワーカー数ごとのスループット', {
+        'jobs': args.jobs,
+        'upstream_latency_seconds': args.upstream_latency,
+        'runs': results,
+    }, args.output)
+
+
+def parse_importtime(stderr):
+    # python -X importtime の出力から (モジュール名, 深さ, 累積マイクロ秒) の一覧を作る
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), depth, int(cumulative)))
+    return entries
+
+
+def bench_importtime(args):
+    import os
+    import statistics
+    import subprocess
+    import sys
+
+    import requests
+
+    from fake_gemini import FakeGemini, start_server
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    # 本番と同じくサービスアカウントで認証する設定でも、importの時点では認証情報を読まない
+    env = {key: value for key, value in os.environ.items() if key != 'GEMINI_STATIC_TOKEN'}
+
+    import_ms, wall_ms = [], []
+    modules = {}
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import main'], cwd=root, env=env, check=True,
+                       capture_output=True)
+        wall_ms.append((time.perf_counter() - start) * 1000)
+
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                                   cwd=root, env=env, check=True, capture_output=True, text=True)
+        entries = parse_importtime(completed.stderr)
+        import_ms.append(next(us for name, depth, us in entries if name == 'main' and depth == 0) / 1000)
+        # main から直接読み込んだモジュールごとの累積時間
+        for name, depth, us in entries:
+            if depth == 1:
+                modules.setdefault(name, []).append(us / 1000)
+
+    # 起動してから最初の /analyze に応答するまで
+    fake = FakeGemini(latency=0.0)
+    fake_server, base_url = start_server(fake)
+    server_env = {
+        'GEMINI_API_BASE': base_url,
+        'GEMINI_STATIC_TOKEN': 'importtime',
+        'RESULT_CACHE_BACKEND': 'none',
+        'UPSTREAM_RATE_LIMIT': '0',
+    }
+    body = make_test_image(320, 240)
+    first_analyze_ms = []
+    try:
+        for _ in range(args.repeat):
+            port = find_free_port()
+            start = time.perf_counter()
+            process = start_app_server('threaded', port, server_env)
+            try:
+                while True:
+                    try:
+                        response = requests.post(f'http://127.0.0.1:{port}/analyze', data=body,
+                                                 headers={'Content-Type': 'image/jpeg'})
+                        break
+                    except requests.exceptions.ConnectionError:
+                        time.sleep(0.005)
+                response.raise_for_status()
+                first_analyze_ms.append((time.perf_counter() - start) * 1000)
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+    finally:
+        fake_server.shutdown()
+
+    slowest = sorted(modules.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+    print_result('起動時間', {
+        'repeat': args.repeat,
+        'import_main_ms': statistics.median(import_ms),
+        'python_import_main_wall_ms': statistics.median(wall_ms),
+        'first_analyze_ms': statistics.median(first_analyze_ms),
+        'slowest_imports_ms': {name: statistics.median(values) for name, values in slowest[:args.top]},
+    }, args.output)
+
+
+def bench_sheets(args):
+    import os
+    import statistics
+    import sys
+
+    # 朝のメッセージ用のスクリプトは backup/ にある
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backup'))
+    from fake_sheets import FakeSheets, start_server
+    from sheets_client import MORNING_RANGES, SheetsClient
+
+    fake = FakeSheets(latency=args.latency)
+    server, api_root = start_server(fake)
+
+    def run(fetch):
+        elapsed, requests = [], []
+        for _ in range(args.repeat):
+            fake.reset()
+            start = time.perf_counter()
+            fetch()
+            elapsed.append((time.perf_counter() - start) * 1000)
+            requests.append(fake.stats()['requests'])
+        return {'elapsed_ms': statistics.median(elapsed), 'requests': statistics.median(requests)}
+
+    def separate():
+        # 以前の get_kyushoku / get_geko / get_remind と同じく、範囲ごとにサービスを作って読む
+        for spreadsheet_id, range_name in MORNING_RANGES:
+            SheetsClient(api_root=api_root, ttl=0).get_values(spreadsheet_id, range_name)
+
+    client = SheetsClient(api_root=api_root)
+    try:
+        results = {
+            'separate': run(separate),
+            'batched': run(lambda: SheetsClient(api_root=api_root).get_ranges(MORNING_RANGES)),
+            'cached': run(lambda: client.get_ranges(MORNING_RANGES)),
+        }
+    finally:
+        server.shutdown()
+
+    print_result('スプレッドシートの読み込み', {
+        'latency_seconds': args.latency,
+        'ranges': len(MORNING_RANGES),
+        'runs': results,
+    }, args.output)
+
+
+def load_corpus(corpus_path):
+    # 記録した画像がなければ synthetic の指定から同じ画像を毎回作る
+    import os
+
+    root = os.path.dirname(os.path.abspath(corpus_path))
+    with open(corpus_path, encoding='utf-8') as f:
+        items = json.load(f)['items']
+    corpus = []
+    for item in items:
+        path = os.path.join(root, item['image']) if item.get('image') else None
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                image = f.read()
+        else:
+            spec = item['synthetic']
+            image = make_test_image(spec['width'], spec['height'], seed=spec['seed'],
+                                    quality=spec.get('quality', 92))
+        vision = item['vision']
+        if not isinstance(vision, str):
+            vision = json.dumps(vision, ensure_ascii=False)
+        corpus.append({'id': item['id'], 'image': image, 'vision_text': vision})
+    return corpus
+
+
+def replay_target(name, calls, concurrency, warmup, alloc_requests, upstream_url):
+    # calls[i]() はステータスを返す。スループットと遅延を測ってから、1件ずつ割り当て量を測る
+    import os
+    import tracemalloc
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+    for call in calls[:warmup]:
+        try:
+            call()
+        except Exception:
+            pass
+    requests.delete(upstream_url + '_stats')
+    # 前のターゲットの最大常駐メモリが残らないよう、ターゲットごとに測り直す
+    peak_rss_reset = reset_peak_rss()
+    rss_kb_before = read_peak_rss_kb(os.getpid(), 'VmRSS')
+
+    def timed(call):
+        start = time.perf_counter()
+        try:
+            status = call()
+        except Exception as e:
+            status = type(e).__name__
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, calls))
+    elapsed = time.perf_counter() - start
+    upstream = requests.get(upstream_url + '_stats').json()
+    # tracemalloc自体が使うメモリを含めないよう、ここで読む
+    peak_rss_kb = read_peak_rss_kb(os.getpid())
+
+    latencies = [latency for latency, _ in outcomes]
+    statuses = {}
+    for _, status in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    # tracemalloc は遅いので、スループットとは別に順番に呼んで測る
+    peaks, retained = [], 0
+    tracemalloc.start()
+    try:
+        for call in calls[:alloc_requests]:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            try:
+                call()
+            except Exception:
+                pass
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained += current - before
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'target': name,
+        'requests': len(calls),
+        'concurrency': concurrency,
+        'elapsed_seconds': elapsed,
+        'throughput_rps': len(calls) / elapsed,
+        'statuses': statuses,
+        'upstream_calls': upstream['total'],
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': max(latencies) * 1000,
+        },
+        'alloc_per_request_kib': {
+            'requests': len(peaks),
+            'peak_mean': sum(peaks) / len(peaks) / 1024 if peaks else 0.0,
+            'peak_max': max(peaks) / 1024 if peaks else 0.0,
+            'retained_mean': retained / len(peaks) / 1024 if peaks else 0.0,
+        },
+        'rss_kb_before': rss_kb_before,
+        'peak_rss_kb': peak_rss_kb,
+        # False なら最大常駐メモリはプロセス開始からの値（前のターゲットを含む）
+        'peak_rss_reset': peak_rss_reset,
+    }
+
+
+def compare_replay(result, baseline):
+    # 前回の結果との比（1より大きいほど今回の値が大きい）
+    previous = {run['target']: run for run in baseline.get('runs', [])}
+    changes = {}
+    for run in result['runs']:
+        old = previous.get(run['target'])
+        if old is None:
+            continue
+        changes[run['target']] = {
+            'throughput_rps': run['throughput_rps'] / old['throughput_rps'],
+            'latency_p50_ms': run['latency_ms']['p50'] / old['latency_ms']['p50'],
+            'latency_p99_ms': run['latency_ms']['p99'] / old['latency_ms']['p99'],
+            'alloc_peak_mean_kib': (run['alloc_per_request_kib']['peak_mean']
+                                    / (old['alloc_per_request_kib']['peak_mean'] or 1)),
+        }
+        if run.get('peak_rss_reset') and old.get('peak_rss_reset'):
+            changes[run['target']]['peak_rss_kb'] = run['peak_rss_kb'] / old['peak_rss_kb']
+    return changes
+
+
+def bench_replay(args):
+    import os
+    import subprocess
+    import sys
+    import threading
+    from concurrent.futures import ProcessPoolExecutor
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    corpus_path = args.corpus or os.path.join(root, 'bench_data', 'corpus.json')
+    # 合成画像を作るときのnumpyのメモリが最大常駐メモリに入らないよう、別プロセスで読み込む
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        corpus = executor.submit(load_corpus, corpus_path).result()
+
+    # スタブは別プロセスで動かし、メモリの計測に含めない
+    port = find_free_port()
+    command = [sys.executable, os.path.join(root, 'fake_gemini.py'), '--port', str(port),
+               '--latency', str(args.upstream_latency), '--jitter', str(args.jitter),
+               '--error-rate', str(args.error_rate), '--error-status', str(args.error_status),
+               '--recordings', corpus_path]
+    upstream = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    upstream_url = f'http://127.0.0.1:{port}/'
+    os.environ.update({
+        'GEMINI_API_BASE': upstream_url + 'v1beta/',
+        'GEMINI_STATIC_TOKEN': 'replay',
+        'PIPELINE_MODE': args.pipeline,
+        'RESULT_CACHE_BACKEND': 'none',
+        'NEAR_DUPLICATE_DISTANCE': '-1',
+        'UPSTREAM_RATE_LIMIT': '0',
+        'LOG_LEVEL': 'WARNING',
+    })
+    try:
+        wait_for_port(port)
+        sys.path.insert(0, root)
+        import main
+        from fake_gemini import make_response
+        from image_utils import ImageData
+
+        baseline_rss_kb = read_peak_rss_kb(os.getpid())
+
+        # 同じ画像の同時リクエストがまとめられないよう、JPEGの終端の後ろに番号を付けて別の画像にする
+        bodies = [corpus[index % len(corpus)]['image'] + index.to_bytes(4, 'big')
+                  for index in range(args.requests)]
+        # Flaskのテストクライアントはスレッドごとに作る
+        local = threading.local()
+
+        def analyze_call(body):
+            def call():
+                if not hasattr(local, 'client'):
+                    local.client = main.app.test_client()
+                response = local.client.post('/analyze', data=body, headers={'Content-Type': 'image/jpeg'})
+                return response.status_code
+            return call
+
+        def vision_call(body):
+            def call():
+                result = main.call_vision_api(ImageData.from_bytes(body))
+                return result[1] if isinstance(result, tuple) else 200
+            return call
+
+        def generate_call(vision_text):
+            vision_response = make_response(vision_text)
+
+            def call():
+                main.call_generate_api(vision_response)
+                return 200
+            return call
+
+        factories = {
+            'analyze': lambda index: analyze_call(bodies[index]),
+            'vision': lambda index: vision_call(bodies[index]),
+            'generate': lambda index: generate_call(corpus[index % len(corpus)]['vision_text']),
+        }
+        runs = []
+        for target in args.targets:
+            calls = [factories[target](index) for index in range(args.requests)]
+            runs.append(replay_target(target, calls, args.concurrency, args.warmup,
+                                      args.alloc_requests, upstream_url))
+    finally:
+        upstream.terminate()
+        upstream.wait(timeout=10)
+
+    result = {
+        'corpus': os.path.relpath(corpus_path, root),
+        'corpus_items': len(corpus),
+        'pipeline': args.pipeline,
+        'upstream_latency_seconds': args.upstream_latency,
+        'upstream_jitter_seconds': args.jitter,
+        'upstream_error_rate': args.error_rate,
+        'peak_rss_kb_after_import': baseline_rss_kb,
+        'runs': runs,
+    }
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            result['vs_baseline'] = compare_replay(result, json.load(f))
+    print_result('記録した画像と応答の再生', result, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='カロリーカメラの性能計測')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    phash_parser = subparsers.add_parser('phash', help='知覚ハッシュインデックスの検索速度')
+    phash_parser.add_argument('--entries', type=int, default=300000)
+    phash_parser.add_argument('--queries', type=int, default=20000)
+    phash_parser.add_argument('--distance', type=int, default=6)
+    phash_parser.add_argument('--chunks', type=int, default=4)
+    phash_parser.add_argument('--seed', type=int, default=0)
+    phash_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    phash_parser.set_defaults(func=bench_phash)
+
+    preprocess_parser = subparsers.add_parser('preprocess', help='画像の縮小・再圧縮で削減できるバイト数と処理時間')
+    preprocess_parser.add_argument('--sizes', nargs='+', default=['640x480', '1280x720', '1920x1080', '4032x3024'])
+    preprocess_parser.add_argument('--max-edge', type=int, default=1024)
+    preprocess_parser.add_argument('--quality', type=int, default=80)
+    preprocess_parser.add_argument('--repeat', type=int, default=10)
+    preprocess_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    preprocess_parser.set_defaults(func=bench_preprocess)
+
+    parser_parser = subparsers.add_parser('parser', help='分析結果パーサーの処理速度')
+    parser_parser.add_argument('--responses', type=int, default=100000)
+    parser_parser.add_argument('--repeat', type=int, default=3)
+    parser_parser.add_argument('--seed', type=int, default=0)
+    parser_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    parser_parser.set_defaults(func=bench_parser)
+
+    logging_parser = subparsers.add_parser('logging', help='リクエストごとのログ出力のオーバーヘッド')
+    logging_parser.add_argument('--requests', type=int, default=100000)
+    logging_parser.add_argument('--sample-rates', type=float, nargs='+', default=[1.0, 0.1])
+    logging_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    logging_parser.set_defaults(func=bench_logging)
+
+    metrics_parser = subparsers.add_parser('metrics', help='メトリクス記録のオーバーヘッドと集計の正確さ')
+    metrics_parser.add_argument('--requests', type=int, default=100000)
+    metrics_parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    metrics_parser.add_argument('--scrapes', type=int, default=100)
+    metrics_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    metrics_parser.set_defaults(func=bench_metrics)
+
+    loadtest_parser = subparsers.add_parser('loadtest', help='ローカルのスタブに対する /analyze の負荷試験')
+    loadtest_parser.add_argument('--modes', nargs='+', default=['threaded', 'async'], choices=['threaded', 'async'])
+    loadtest_parser.add_argument('--routes', nargs='+', default=['analyze', 'stream'], choices=['analyze', 'stream'])
+    loadtest_parser.add_argument('--concurrency', type=int, default=200)
+    loadtest_parser.add_argument('--requests', type=int, default=1000)
+    loadtest_parser.add_argument('--upstream-latency', type=float, default=0.5)
+    loadtest_parser.add_argument('--upstream-concurrency', type=int, default=256)
+    loadtest_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    loadtest_parser.set_defaults(func=bench_loadtest)
+
+    batch_parser = subparsers.add_parser('batch', help='/analyze/batch の同時処理数ごとのスループット')
+    batch_parser.add_argument('--images', type=int, default=32)
+    batch_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    batch_parser.add_argument('--upstream-latency', type=float, default=0.3)
+    batch_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    batch_parser.set_defaults(func=bench_batch)
+
+    coalesce_parser = subparsers.add_parser('coalesce', help='同一画像の同時リクエストでGemini APIを何回呼ぶか')
+    coalesce_parser.add_argument('--modes', nargs='+', default=['threaded', 'async'], choices=['threaded', 'async'])
+    coalesce_parser.add_argument('--duplicates', type=int, default=20)
+    coalesce_parser.add_argument('--rounds', type=int, default=5)
+    coalesce_parser.add_argument('--upstream-latency', type=float, default=0.5)
+    coalesce_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    coalesce_parser.set_defaults(func=bench_coalesce)
+
+    ratelimit_parser = subparsers.add_parser('ratelimit', help='割り当てのあるスタブに対する流量制御の効果')
+    ratelimit_parser.add_argument('--mode', default='async', choices=['threaded', 'async'])
+    ratelimit_parser.add_argument('--quota', type=int, default=20, help='スタブの1秒あたりの上限')
+    ratelimit_parser.add_argument('--initial-rate', type=float, default=10)
+    ratelimit_parser.add_argument('--requests', type=int, default=300)
+    ratelimit_parser.add_argument('--concurrency', type=int, default=50)
+    ratelimit_parser.add_argument('--queue-size', type=int, default=64)
+    ratelimit_parser.add_argument('--batch-waiters', type=int, default=100)
+    ratelimit_parser.add_argument('--upstream-latency', type=float, default=0.2)
+    ratelimit_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    ratelimit_parser.set_defaults(func=bench_ratelimit)
+
+    stream_parser = subparsers.add_parser('stream', help='/analyze と /analyze/stream の最初の料理までの時間')
+    stream_parser.add_argument('--requests', type=int, default=20)
+    stream_parser.add_argument('--upstream-latency', type=float, default=0.5)
+    stream_parser.add_argument('--chunk-chars', type=int, default=24)
+    stream_parser.add_argument('--chunk-delay', type=float, default=0.05)
+    stream_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    stream_parser.set_defaults(func=bench_stream)
+
+    caloriedb_parser = subparsers.add_parser('caloriedb', help='カロリー参照表の読み込みと検索の速度')
+    caloriedb_parser.add_argument('--repeat', type=int, default=100000)
+    caloriedb_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    caloriedb_parser.set_defaults(func=bench_caloriedb)
+
+    jobs_parser = subparsers.add_parser('jobs', help='/analyze の非同期ジョブのワーカー数ごとのスループット')
+    jobs_parser.add_argument('--jobs', type=int, default=40)
+    jobs_parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    jobs_parser.add_argument('--backends', nargs='+', default=['memory', 'sqlite'], choices=['memory', 'sqlite'])
+    jobs_parser.add_argument('--upstream-latency', type=float, default=0.3)
+    jobs_parser.add_argument('--poll-interval', type=float, default=0.05)
+    jobs_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    jobs_parser.set_defaults(func=bench_jobs)
+
+    importtime_parser = subparsers.add_parser('importtime', help='main の読み込み時間と最初の /analyze までの時間')
+    importtime_parser.add_argument('--repeat', type=int, default=5)
+    importtime_parser.add_argument('--top', type=int, default=10)
+    importtime_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    importtime_parser.set_defaults(func=bench_importtime)
+
+    sheets_parser = subparsers.add_parser('sheets', help='朝のメッセージ用のスプレッドシートの読み込み回数と時間')
+    sheets_parser.add_argument('--latency', type=float, default=0.1)
+    sheets_parser.add_argument('--repeat', type=int, default=5)
+    sheets_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    sheets_parser.set_defaults(func=bench_sheets)
+
+    replay_parser = subparsers.add_parser('replay', help='記録した画像と応答をスタブで再生し、分析処理の性能を測る')
+    replay_parser.add_argument('--corpus', help='既定は bench_data/corpus.json')
+    replay_parser.add_argument('--targets', nargs='+', default=['analyze', 'vision', 'generate'],
+                               choices=['analyze', 'vision', 'generate'])
+    replay_parser.add_argument('--pipeline', default='single', choices=['single', 'two_step'])
+    replay_parser.add_argument('--requests', type=int, default=200)
+    replay_parser.add_argument('--concurrency', type=int, default=8)
+    replay_parser.add_argument('--warmup', type=int, default=5)
+    replay_parser.add_argument('--alloc-requests', type=int, default=20, help='tracemallocで測るリクエスト数')
+    replay_parser.add_argument('--upstream-latency', type=float, default=0.05)
+    replay_parser.add_argument('--jitter', type=float, default=0.0)
+    replay_parser.add_argument('--error-rate', type=float, default=0.0)
+    replay_parser.add_argument('--error-status', type=int, default=503)
+    replay_parser.add_argument('--baseline', help='比較する以前の結果のJSONファイル')
+    replay_parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    replay_parser.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def image_digest(raw):
+    return hashlib.sha256(raw).hexdigest()
+
+
+def make_cache_key(digest, *parts):
+    # モデル名やプロンプトのバージョンが変わったら別のキーになる
+    return ':'.join(str(part) for part in parts) + ':' + digest
+
+
+class MemoryCache:
+    """LRU・TTL付きのインメモリ結果キャッシュ"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """再起動後も結果を保持するSQLiteの結果キャッシュ"""
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT NOT NULL,'
+            ' expires_at REAL NOT NULL,'
+            ' accessed_at REAL NOT NULL)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)')
+
+    def get(self, key):
+        # 再起動をまたぐのでここでは壁時計の時刻を使う
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM results WHERE key = ? AND expires_at > ?',
+                (key, now)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                'UPDATE results SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO results (key, value, expires_at, accessed_at)'
+                ' VALUES (?, ?, ?, ?)',
+                (key, data, now + self.ttl, now))
+            self._conn.execute('DELETE FROM results WHERE expires_at <= ?', (now,))
+            self._conn.execute(
+                'DELETE FROM results WHERE key IN ('
+                ' SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+class NullCache:
+    hits = 0
+    misses = 0
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+def make_result_cache():
+    backend = os.getenv('RESULT_CACHE_BACKEND', 'memory')
+    max_entries = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+    ttl = float(os.getenv('RESULT_CACHE_TTL', DEFAULT_TTL))
+
+    if backend == 'memory':
+        return MemoryCache(max_entries, ttl)
+    if backend == 'sqlite':
+        # Vercelなどでは書き込み可能なのは一時ディレクトリのみ
+        path = os.getenv('RESULT_CACHE_PATH') or os.path.join(
+            tempfile.gettempdir(), 'calcam_result_cache.sqlite3')
+        return SQLiteCache(path, max_entries, ttl)
+    if backend == 'none':
+        return NullCache()
+    raise ValueError(f'不明なRESULT_CACHE_BACKENDです: {backend}')
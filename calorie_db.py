@@ -0,0 +1,204 @@
+import mmap
+import os
+import re
+import threading
+import unicodedata
+from array import array
+from dataclasses import dataclass
+
+DEFAULT_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calorie_table.tsv')
+
+# カタカナをひらがなにそろえる（ァ〜ヶ → ぁ〜ゖ）
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord('ァ'), ord('ヶ') + 1)}
+# 「唐揚げ（レモン添え）」の括弧内のような補足は照合に使わない
+_BRACKETS = re.compile(r'[(\[【][^)\]】]*[)\]】]')
+_IGNORED = re.compile(r'[\s・、,.。/「」『』〜~]')
+
+_KANJI_NUMBERS = str.maketrans('一二三四五六七八九', '123456789')
+# 分量の数と単位（「2杯」「6個」「200g」「1/2杯」など）。½ はNFKCで 1⁄2 になる
+_COUNT = re.compile(
+    r'(\d+(?:\.\d+)?)(?:\s*[/⁄]\s*(\d+))?\s*(杯|個|人前|皿|切れ|枚|本|貫|尾|玉|丁|パック|g|グラム)')
+# 数の代わりに大きさで書かれた分量の倍率
+_SIZE_FACTORS = (
+    ('特盛', 2.0),
+    ('大盛', 1.5),
+    ('多め', 1.3),
+    ('小盛', 0.7),
+    ('少なめ', 0.7),
+    ('半人前', 0.5),
+    ('半分', 0.5),
+    ('ハーフ', 0.5),
+)
+
+
+def normalize_name(name):
+    # 全角・半角、大文字・小文字、カタカナ・ひらがなの違いをなくす
+    text = unicodedata.normalize('NFKC', name).lower()
+    text = _BRACKETS.sub('', text)
+    text = _IGNORED.sub('', text)
+    return text.translate(_KATAKANA_TO_HIRAGANA)
+
+
+def bigrams(text):
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def parse_count(portion):
+    # 分量の文字列から (数, 単位) を取り出す。見つからなければ None
+    text = unicodedata.normalize('NFKC', portion).translate(_KANJI_NUMBERS)
+    match = _COUNT.search(text)
+    if match is None:
+        return None
+    amount = float(match.group(1))
+    if match.group(2) is not None:
+        denominator = float(match.group(2))
+        if not denominator:
+            return None
+        amount /= denominator
+    unit = match.group(3)
+    return amount, 'g' if unit == 'グラム' else unit
+
+
+@dataclass(slots=True)
+class CalorieEntry:
+    name: str
+    kcal: float
+    portion: str
+    grams: float
+    cooking_method: str
+
+    def scale(self, portion):
+        # 標準の分量に対する倍率を掛けたカロリーを返す
+        if not portion:
+            return self.kcal
+        text = unicodedata.normalize('NFKC', portion)
+        factor = 1.0
+        for word, size_factor in _SIZE_FACTORS:
+            if word in text:
+                factor = size_factor
+                break
+
+        count = parse_count(text)
+        if count is not None:
+            amount, unit = count
+            standard = parse_count(self.portion)
+            if unit == 'g':
+                if self.grams:
+                    factor = amount / self.grams
+            elif standard is not None and standard[1] == unit:
+                factor *= amount / standard[0]
+            else:
+                # 「2人前」など単位が違う場合は標準の分量の何倍かとみなす
+                factor *= amount
+        return self.kcal * factor
+
+
+class CalorieDB:
+    """料理名からカロリーを引く参照表
+
+    最初に引いたときにTSVファイルをメモリマップし、名前と別名の索引だけを作る。
+    行の中身は見つかったときに読む。完全一致しない名前は、バイグラムがすべて
+    表の名前に含まれるもののうち、文字バイグラムのDice係数で最も近いものを使う。
+    「唐揚げ丼」→「唐揚げ」のように表にない語を含む名前は、別の料理なので使わない。
+    """
+
+    def __init__(self, path=DEFAULT_TABLE_PATH, min_score=0.7):
+        self.path = path
+        self.min_score = min_score
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._mmap = None
+        self._offsets = array('L')
+        self._exact = {}
+        self._keys = []
+        self._postings = {}
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        start = 0
+        size = len(self._mmap)
+        while start < size:
+            end = self._mmap.find(b'\n', start)
+            if end == -1:
+                end = size
+            line = self._mmap[start:end]
+            if line.strip() and not line.startswith(b'#'):
+                self._add_record(len(self._offsets), line.decode('utf-8'))
+                self._offsets.append(start)
+            start = end + 1
+
+    def _add_record(self, record_id, line):
+        fields = line.rstrip('\r').split('\t')
+        if len(fields) != 6:
+            raise ValueError(f'カロリー表の行の形式が不正です: {line}')
+        names = [fields[0]] + [alias for alias in fields[1].split('|') if alias]
+        for name in names:
+            key = normalize_name(name)
+            if not key or key in self._exact:
+                continue
+            self._exact[key] = record_id
+            key_id = len(self._keys)
+            grams = bigrams(key)
+            self._keys.append((record_id, len(grams)))
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(key_id)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._load()
+                self._loaded = True
+
+    def _record(self, record_id):
+        start = self._offsets[record_id]
+        end = self._mmap.find(b'\n', start)
+        line = self._mmap[start:end if end != -1 else len(self._mmap)].decode('utf-8')
+        name, _, kcal, portion, grams, cooking_method = line.rstrip('\r').split('\t')
+        return CalorieEntry(name, float(kcal), portion, float(grams or 0), cooking_method)
+
+    def _fuzzy(self, key):
+        grams = bigrams(key)
+        if not grams:
+            return None
+        overlaps = {}
+        for gram in grams:
+            for key_id in self._postings.get(gram, ()):
+                overlaps[key_id] = overlaps.get(key_id, 0) + 1
+
+        best_id, best_score = None, self.min_score
+        for key_id, overlap in overlaps.items():
+            if overlap < len(grams):
+                continue
+            score = 2 * overlap / (len(grams) + self._keys[key_id][1])
+            if score >= best_score:
+                best_id, best_score = key_id, score
+        return None if best_id is None else self._keys[best_id][0]
+
+    def lookup(self, name):
+        # 見つからなければ None
+        self._ensure_loaded()
+        key = normalize_name(name)
+        record_id = self._exact.get(key)
+        if record_id is None:
+            record_id = self._fuzzy(key)
+        if record_id is None:
+            return None
+        return self._record(record_id)
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._offsets)
+
+
+def make_calorie_db():
+    # CALORIE_TABLE_PATH を空にすると無効
+    path = os.getenv('CALORIE_TABLE_PATH', DEFAULT_TABLE_PATH)
+    if not path:
+        return None
+    return CalorieDB(path, min_score=float(os.getenv('CALORIE_MATCH_THRESHOLD', 0.7)))
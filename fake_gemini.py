@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# ローカル検証用のGemini APIスタブサーバー
+#
+#   python fake_gemini.py --port 8001 --latency 0.2 --error-rate 0.05
+#   python fake_gemini.py --port 8001 --quota 20   # 1秒あたり20件を超えると429
+#   python fake_gemini.py --port 8001 --recordings bench_data/corpus.json   # 記録した応答を順に返す
+#   GEMINI_API_BASE=http://127.0.0.1:8001/v1beta/ GEMINI_STATIC_TOKEN=dummy python main.py
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODEL_PATH = re.compile(r'^/v1beta/models/(?P<model>[^/:]+):(?P<method>\w+)')
+
+DEFAULT_RESULT = {
+    'dishes': [
+        {'name': '白ご飯', 'kcal': 252, 'cooking_method': '炊飯', 'portion': '茶碗1杯'},
+        {'name': '味噌汁', 'kcal': 40, 'cooking_method': '煮る', 'portion': '1杯'},
+        {'name': '鶏の唐揚げ', 'kcal': 290, 'cooking_method': '揚げる', 'portion': '4個'},
+        {'name': 'サラダ', 'kcal': 30, 'cooking_method': '生', 'portion': '小鉢1杯'},
+    ],
+    'total_kcal': 612,
+}
+
+# Vision APIの応答（料理名と分量の一覧）
+DEFAULT_TEXT = json.dumps({'dishes': [
+    {'name': dish['name'], 'cooking_method': dish['cooking_method'], 'portion': dish['portion']}
+    for dish in DEFAULT_RESULT['dishes']
+]}, ensure_ascii=False)
+
+
+def load_recordings(path):
+    # ベンチマーク用コーパスの記録した応答を (Vision APIのテキスト, 分析結果) の一覧にする
+    with open(path, encoding='utf-8') as f:
+        items = json.load(f)['items']
+    recordings = []
+    for item in items:
+        vision = item['vision']
+        if not isinstance(vision, str):
+            vision = json.dumps(vision, ensure_ascii=False)
+        recordings.append((vision, item['result']))
+    return recordings
+
+
+def response_text(model, request_body, text, result):
+    # visionモデルは説明文、それ以外は分析結果のJSONを返す
+    if 'vision' in model:
+        return text
+    result = json.dumps(result, ensure_ascii=False)
+    config = request_body.get('generationConfig', {}) if isinstance(request_body, dict) else {}
+    if config.get('responseMimeType') == 'application/json':
+        return result
+    # 構造化出力を使わない場合、実際のモデルはコードブロックで囲んで返すことが多い
+    return f'分析結果です。\n```json\n{result}\n```'
+
+
+def stream_text(result):
+    # streamGenerateContent 用。料理ごとに1行のJSON、最後の行に合計
+    lines = [json.dumps(dish, ensure_ascii=False) for dish in result['dishes']]
+    lines.append(json.dumps({'total_kcal': result['total_kcal']}))
+    return '\n'.join(lines) + '\n'
+
+
+def split_chunks(text, size):
+    # 実際のモデルと同様に、行の途中でも区切って少しずつ返す
+    return [text[i:i + size] for i in range(0, len(text), size)] or ['']
+
+
+def make_response(text):
+    return {
+        'candidates': [{
+            'content': {'parts': [{'text': text}], 'role': 'model'},
+            'finishReason': 'STOP',
+            'index': 0,
+            'safetyRatings': [
+                {'category': 'HARM_CATEGORY_HARASSMENT', 'probability': 'NEGLIGIBLE'},
+                {'category': 'HARM_CATEGORY_HATE_SPEECH', 'probability': 'NEGLIGIBLE'},
+            ],
+        }],
+        'usageMetadata': {'promptTokenCount': 258, 'candidatesTokenCount': 64, 'totalTokenCount': 322},
+    }
+
+
+class FakeGemini:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503,
+                 retry_after=None, text=DEFAULT_TEXT, result=None, quota=None,
+                 chunk_chars=24, chunk_delay=0.0, recordings=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.text = text
+        self.result = result or DEFAULT_RESULT
+        # モデルごとの1秒あたりの上限（Noneで無制限）
+        self.quota = quota
+        # 生成の速さ。chunk_chars 文字ごとに chunk_delay 秒かかる（ストリームでない場合も合計分待つ）
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+        # 記録した (Vision APIのテキスト, 分析結果) をモデルごとに順番に返す
+        self.recordings = recordings
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttled = 0
+        self._windows = {}
+
+    def record(self, model):
+        # このモデルへの何回目の呼び出しかを返す
+        with self.lock:
+            self.calls[model] = self.calls.get(model, 0) + 1
+            return self.calls[model]
+
+    def responses(self, count):
+        # count 回目の呼び出しで返す (Vision APIのテキスト, 分析結果)
+        if not self.recordings:
+            return self.text, self.result
+        return self.recordings[(count - 1) % len(self.recordings)]
+
+    def admit(self, model):
+        # 1秒ごとの固定ウィンドウで数え、上限を超えたら False
+        if not self.quota:
+            return True
+        window = int(time.monotonic())
+        with self.lock:
+            start, count = self._windows.get(model, (window, 0))
+            if start != window:
+                start, count = window, 0
+            if count >= self.quota:
+                self.throttled += 1
+                return False
+            self._windows[model] = (start, count + 1)
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'total': sum(self.calls.values()),
+                    'throttled': self.throttled}
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled = 0
+            self._windows.clear()
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 負荷試験で同時に大量の接続を受けられるようにする
+    request_queue_size = 1024
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def write_chunk(self, data):
+            self.wfile.write(f'{len(data):x}\r\n'.encode('latin-1') + data + b'\r\n')
+
+        def send_stream(self, chunks):
+            # Server-Sent Events をチャンク転送で1イベントずつ送る
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for index, chunk in enumerate(chunks):
+                if index and fake.chunk_delay:
+                    time.sleep(fake.chunk_delay)
+                event = json.dumps(make_response(chunk), ensure_ascii=False)
+                self.write_chunk(f'data: {event}\r\n\r\n'.encode('utf-8'))
+            self.write_chunk(b'')
+
+        def do_GET(self):
+            if self.path == '/_stats':
+                self.send_json(200, fake.stats())
+            else:
+                self.send_json(404, {'error': {'code': 404, 'status': 'NOT_FOUND', 'message': self.path}})
+
+        def do_DELETE(self):
+            if self.path == '/_stats':
+                fake.reset()
+                self.send_json(200, {})
+            else:
+                self.send_json(404, {'error': {'code': 404, 'status': 'NOT_FOUND', 'message': self.path}})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                request_body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                request_body = {}
+
+            match = MODEL_PATH.match(self.path)
+            if not match:
+                self.send_json(404, {'error': {'code': 404, 'status': 'NOT_FOUND', 'message': self.path}})
+                return
+            model = match.group('model')
+            text, result = fake.responses(fake.record(model))
+
+            if not fake.admit(model):
+                self.send_json(429, {'error': {
+                    'code': 429,
+                    'status': 'RESOURCE_EXHAUSTED',
+                    'message': 'Resource has been exhausted (e.g. check quota).',
+                }})
+                return
+
+            delay = fake.latency + random.uniform(0, fake.jitter)
+            if delay:
+                time.sleep(delay)
+
+            if fake.error_rate and random.random() < fake.error_rate:
+                headers = {}
+                if fake.retry_after is not None:
+                    headers['Retry-After'] = str(fake.retry_after)
+                self.send_json(fake.error_status, {'error': {
+                    'code': fake.error_status,
+                    'status': 'UNAVAILABLE',
+                    'message': 'The model is overloaded. Please try again later.',
+                }}, headers)
+                return
+
+            if match.group('method') == 'streamGenerateContent':
+                self.send_stream(split_chunks(stream_text(result), fake.chunk_chars))
+                return
+
+            text = response_text(model, request_body, text, result)
+            if fake.chunk_delay and 'vision' not in model:
+                # ストリームで返す場合と同じだけ生成に時間がかかったことにする
+                time.sleep(fake.chunk_delay * (len(split_chunks(text, fake.chunk_chars)) - 1))
+            self.send_json(200, make_response(text))
+
+    return Handler
+
+
+def start_server(fake=None, host='127.0.0.1', port=0):
+    # テストやベンチマークから使う場合はスレッドで起動する
+    fake = fake or FakeGemini()
+    server = FakeGeminiServer((host, port), make_handler(fake))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f'http://{host}:{server.server_address[1]}/v1beta/'
+    return server, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gemini APIスタブサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0, help='応答までの遅延（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='遅延に加えるランダム幅（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='エラーを返す割合')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--retry-after', type=float, default=None)
+    parser.add_argument('--quota', type=int, default=None, help='モデルごとの1秒あたりの上限')
+    parser.add_argument('--chunk-chars', type=int, default=24, help='ストリームの1チャンクの文字数')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='チャンクごとの生成時間（秒）')
+    parser.add_argument('--recordings', help='記録した応答を順に返す（benchmark.py replay のコーパス）')
+    args = parser.parse_args()
+
+    fake = FakeGemini(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                      error_status=args.error_status, retry_after=args.retry_after, quota=args.quota,
+                      chunk_chars=args.chunk_chars, chunk_delay=args.chunk_delay,
+                      recordings=load_recordings(args.recordings) if args.recordings else None)
+    server = FakeGeminiServer((args.host, args.port), make_handler(fake))
+    print(f"Gemini APIスタブ: http://{args.host}:{args.port}/v1beta/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import base64
+
+JPEG_MAGIC = b'\xff\xd8'
+PNG_MAGIC = b'\x89PNG'
+
+DATA_URL_PREFIXES = {
+    'data:image/jpeg;base64,': 'image/jpeg',
+    'data:image/png;base64,': 'image/png',
+}
+
+
+def sniff_mime_type(data):
+    # 先頭数バイトだけをコピーせずに確認する
+    head = memoryview(data)[:8]
+    if head[:2] == JPEG_MAGIC:
+        return 'image/jpeg'
+    if head[:4] == PNG_MAGIC:
+        return 'image/png'
+    return None
+
+
+def normalize_base64(base64_data):
+    # URLセーフ文字の置換とパディングの補完を一度だけ行う
+    base64_data = base64_data.replace('-', '+').replace('_', '/')
+    padding_needed = len(base64_data) % 4
+    if padding_needed:
+        base64_data += '=' * (4 - padding_needed)
+    return base64_data
+
+
+class ImageData:
+    """アップロード画像。バイナリとBase64のどちらか一方から作り、もう一方は必要になった時点で一度だけ変換する"""
+
+    __slots__ = ('_raw', '_b64', 'mime_type')
+
+    def __init__(self, raw=None, b64=None, mime_type=None):
+        self._raw = raw
+        self._b64 = b64
+        self.mime_type = mime_type
+
+    @classmethod
+    def from_bytes(cls, raw):
+        if not raw:
+            raise ValueError('画像データが空です')
+        mime_type = sniff_mime_type(raw)
+        if mime_type is None:
+            raise ValueError('サポートされていない画像形式です')
+        return cls(raw=raw, mime_type=mime_type)
+
+    @classmethod
+    def from_data_url(cls, image_data):
+        if not isinstance(image_data, str):
+            raise ValueError('画像データはデータURLの文字列で送信してください')
+        for prefix, expected_type in DATA_URL_PREFIXES.items():
+            if image_data.startswith(prefix):
+                break
+        else:
+            raise ValueError('無効な画像データ形式')
+
+        base64_data = normalize_base64(image_data[len(prefix):])
+        if not base64_data:
+            raise ValueError('Base64データが空です')
+
+        # 形式の確認には先頭12文字（9バイト）だけをデコードする
+        try:
+            head = base64.b64decode(base64_data[:12])
+        except Exception as e:
+            raise ValueError(f'Base64データの処理に失敗しました: {str(e)}')
+        mime_type = sniff_mime_type(head)
+        if mime_type is None:
+            raise ValueError('サポートされていない画像形式です')
+        if mime_type != expected_type:
+            raise ValueError('データURLの形式と画像の内容が一致しません')
+        return cls(b64=base64_data, mime_type=mime_type)
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            try:
+                self._raw = base64.b64decode(self._b64)
+            except Exception as e:
+                raise ValueError(f'Base64データの処理に失敗しました: {str(e)}')
+        return self._raw
+
+    @property
+    def b64(self):
+        if self._b64 is None:
+            self._b64 = base64.b64encode(self._raw).decode('ascii')
+        return self._b64
+
+    @property
+    def size(self):
+        if self._raw is not None:
+            return len(self._raw)
+        return len(self._b64) * 3 // 4 - self._b64.count('=', -2)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+# /analyze の非同期モード（Prefer: respond-async または ?async=1）のジョブキュー
+#
+# Vercelなどのサーバーレス環境ではレスポンスを返した後にプロセスが止められることがあるので、
+# JOB_BACKEND=sqlite にして別プロセスのワーカーで処理する:
+#
+#   JOB_BACKEND=sqlite JOB_WORKERS=0 gunicorn main:app      # Webはジョブを積むだけ
+#   JOB_BACKEND=sqlite python jobs.py --workers 4           # ワーカー
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from image_utils import ImageData
+
+DEFAULT_TTL = 60 * 60
+# 処理中のまま、この秒数を過ぎたジョブはワーカーが落ちたとみなして積み直す
+DEFAULT_LEASE = 120
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def _job_view(job_id, status, status_code, body, created_at, updated_at):
+    # GET /analyze/<id> のレスポンス形式
+    view = {'id': job_id, 'status': status, 'created_at': created_at, 'updated_at': updated_at}
+    if status == DONE:
+        view['result'] = body
+    elif status == FAILED:
+        view['status_code'] = status_code
+        view['error'] = body.get('error') if isinstance(body, dict) else body
+    return view
+
+
+class MemoryJobStore:
+    """プロセス内のジョブ保存先（再起動すると消える）"""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_queued=1000):
+        self.ttl = ttl
+        self.max_queued = max_queued
+        self._jobs = OrderedDict()
+        self._queue = deque()
+        self._lock = threading.Lock()
+
+    def enqueue(self, image):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            if len(self._queue) >= self.max_queued:
+                raise JobQueueFull('処理待ちのジョブが多すぎます')
+            self._jobs[job_id] = {
+                'status': QUEUED, 'image': image, 'status_code': None, 'body': None,
+                'created_at': now, 'updated_at': now,
+            }
+            self._queue.append(job_id)
+        return job_id
+
+    def claim(self):
+        # 次のジョブを処理中にして (ID, 画像) を返す。なければ None
+        with self._lock:
+            while self._queue:
+                job_id = self._queue.popleft()
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    job['status'] = RUNNING
+                    job['updated_at'] = time.time()
+                    return job_id, job['image']
+        return None
+
+    def complete(self, job_id, status_code, body):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(status=DONE if status_code == 200 else FAILED, status_code=status_code,
+                       body=body, image=None, updated_at=time.time())
+            self._jobs.move_to_end(job_id)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return _job_view(job_id, job['status'], job['status_code'], job['body'],
+                             job['created_at'], job['updated_at'])
+
+    def _purge(self, now):
+        # 終わったジョブは完了順に並んでいるので、古いものから消す
+        for job_id in list(self._jobs):
+            job = self._jobs[job_id]
+            if job['status'] in (QUEUED, RUNNING):
+                continue
+            if job['updated_at'] > now - self.ttl:
+                break
+            del self._jobs[job_id]
+
+
+class SQLiteJobStore:
+    """再起動後も残り、別プロセスのワーカーとも共有できるSQLiteのジョブ保存先"""
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_queued=1000, lease=DEFAULT_LEASE):
+        self.path = path
+        self.ttl = ttl
+        self.max_queued = max_queued
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id TEXT PRIMARY KEY,'
+            ' status TEXT NOT NULL,'
+            ' image BLOB,'
+            ' mime_type TEXT,'
+            ' status_code INTEGER,'
+            ' body TEXT,'
+            ' created_at REAL NOT NULL,'
+            ' updated_at REAL NOT NULL)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at)')
+
+    def _transaction(self, fn):
+        # 他のプロセスのワーカーと同じジョブを取り合わないよう書き込みロックを取る
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return result
+
+    def enqueue(self, image):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+
+        def insert(conn):
+            queued = conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE status = ?', (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                raise JobQueueFull('処理待ちのジョブが多すぎます')
+            conn.execute(
+                'INSERT INTO jobs (id, status, image, mime_type, created_at, updated_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, QUEUED, image.raw, image.mime_type, now, now))
+
+        self._transaction(insert)
+        return job_id
+
+    def claim(self):
+        now = time.time()
+
+        def claim_next(conn):
+            conn.execute(
+                'UPDATE jobs SET status = ?, updated_at = ? WHERE status = ? AND updated_at < ?',
+                (QUEUED, now, RUNNING, now - self.lease))
+            row = conn.execute(
+                'SELECT id, image, mime_type FROM jobs WHERE status = ?'
+                ' ORDER BY created_at LIMIT 1', (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                'UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?', (RUNNING, now, row[0]))
+            return row[0], ImageData(raw=row[1], mime_type=row[2])
+
+        return self._transaction(claim_next)
+
+    def complete(self, job_id, status_code, body):
+        now = time.time()
+
+        def update(conn):
+            conn.execute(
+                'UPDATE jobs SET status = ?, status_code = ?, body = ?, image = NULL, updated_at = ?'
+                ' WHERE id = ?',
+                (DONE if status_code == 200 else FAILED, status_code,
+                 json.dumps(body, ensure_ascii=False), now, job_id))
+            conn.execute(
+                'DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?',
+                (DONE, FAILED, now - self.ttl))
+
+        self._transaction(update)
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT status, status_code, body, created_at, updated_at FROM jobs WHERE id = ?',
+                (job_id,)).fetchone()
+        if row is None:
+            return None
+        status, status_code, body, created_at, updated_at = row
+        return _job_view(job_id, status, status_code, json.loads(body) if body else None,
+                         created_at, updated_at)
+
+
+class JobQueue:
+    """ジョブを保存先に積み、ワーカースレッドで1件ずつ処理する
+
+    handler(job_id, image) は (レスポンス本文, ステータスコード) を返す。
+    ワーカーは最初のジョブが積まれたときに起動する。
+    """
+
+    def __init__(self, store, handler, workers=4, poll_interval=1.0):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Semaphore(0)
+        self._stop = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+    def submit(self, image):
+        job_id = self.store.enqueue(image)
+        self.start()
+        self._wakeup.release()
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def start(self):
+        if self._threads or not self.workers:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'job-worker-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while not self._stop.is_set():
+            claimed = self.store.claim()
+            if claimed is None:
+                # 別のプロセスが積んだジョブにも気付けるよう、一定間隔で確認する
+                self._wakeup.acquire(timeout=self.poll_interval)
+                continue
+            job_id, image = claimed
+            try:
+                body, status_code = self.handler(job_id, image)
+            except Exception as e:
+                body, status_code = {'error': str(e)}, 500
+            self.store.complete(job_id, status_code, body)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while not self._stop.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self):
+        self._stop.set()
+        for _ in self._threads:
+            self._wakeup.release()
+
+
+def make_job_store():
+    backend = os.getenv('JOB_BACKEND', 'memory')
+    ttl = float(os.getenv('JOB_TTL', DEFAULT_TTL))
+    max_queued = int(os.getenv('JOB_MAX_QUEUED', 1000))
+
+    if backend == 'memory':
+        return MemoryJobStore(ttl, max_queued)
+    if backend == 'sqlite':
+        path = os.getenv('JOB_DB_PATH') or os.path.join(tempfile.gettempdir(), 'calcam_jobs.sqlite3')
+        return SQLiteJobStore(path, ttl, max_queued, float(os.getenv('JOB_LEASE', DEFAULT_LEASE)))
+    raise ValueError(f'不明なJOB_BACKENDです: {backend}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/analyze の非同期ジョブを処理するワーカー')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('JOB_WORKERS', 4)))
+    args = parser.parse_args()
+
+    # Webプロセスと同じ分析処理を使う
+    import main as app_module
+
+    if isinstance(app_module.job_queue.store, MemoryJobStore):
+        parser.error('別プロセスのワーカーには JOB_BACKEND=sqlite が必要です')
+    queue = JobQueue(app_module.job_queue.store, app_module.run_job, args.workers)
+    print(f"ジョブワーカーを起動しました: workers={args.workers}")
+    queue.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+LOGGER_NAME = 'calcam'
+
+
+class JsonFormatter(logging.Formatter):
+    # 1行1イベントのJSON。フィールドは extra={'fields': {...}} で渡す
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'event': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # リクエストのスレッドでは整形もI/Oもせず、キューに積むだけにする
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 整形は書き出し側のスレッドで行う
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # 書き出しが追いつかない場合は待たずに捨てる
+            self.dropped += 1
+
+
+class StructuredLogger:
+    """イベント名とフィールドを1行のJSONとして出力するロガー
+
+    INFO以下は sample_rate の割合だけ残し、WARNING以上は常に残す。
+    間引く判定はLogRecordを作る前に行う。
+    """
+
+    __slots__ = ('logger', 'sample_rate', 'listener')
+
+    def __init__(self, logger, sample_rate, listener):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.listener = listener
+
+    def log(self, level, event, fields):
+        logger = self.logger
+        if not logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        # logger.info などは呼び出し元のスタックを辿るので、レコードを直接作る
+        record = logger.makeRecord(logger.name, level, '', 0, event, None, None,
+                                   extra={'fields': fields})
+        logger.handle(record)
+
+    def stop(self):
+        self.listener.stop()
+
+
+def setup_logging(name=LOGGER_NAME, stream=None, level=None, sample_rate=None, queue_size=None):
+    level = level or os.getenv('LOG_LEVEL', 'INFO')
+    sample_rate = sample_rate if sample_rate is not None else float(os.getenv('LOG_SAMPLE_RATE', 1.0))
+    queue_size = queue_size or int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    return StructuredLogger(logger, sample_rate, listener)
+
+
+structured_logger = setup_logging()
+atexit.register(structured_logger.stop)
+
+
+def debug(event, **fields):
+    structured_logger.log(logging.DEBUG, event, fields)
+
+
+def info(event, **fields):
+    structured_logger.log(logging.INFO, event, fields)
+
+
+def warning(event, **fields):
+    structured_logger.log(logging.WARNING, event, fields)
+
+
+def error(event, **fields):
+    structured_logger.log(logging.ERROR, event, fields)
+
+
+class _Stage:
+    # contextlib.contextmanager より軽いので、ステージ計測にはこちらを使う
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stages = self.timings.stages
+        stages[self.name] = stages.get(self.name, 0.0) + (time.perf_counter() - self.start)
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class StageTimings:
+    """1リクエスト内の各ステージの所要時間（秒）"""
+
+    __slots__ = ('stages', 'started')
+
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def as_fields(self):
+        return {
+            'stages_ms': {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+            'total_ms': round(self.total() * 1000, 2),
+        }
+
+
+_current_timings = contextvars.ContextVar('calcam_timings', default=None)
+
+
+class timed_request:
+    # with の中で呼ばれた stage() はこのリクエストの計測に記録される
+    # timings を渡すと、with の前に計測を始めていたリクエストの続きとして記録する
+    __slots__ = ('timings', 'token')
+
+    def __init__(self, timings=None):
+        self.timings = timings
+
+    def __enter__(self):
+        if self.timings is None:
+            self.timings = StageTimings()
+        self.token = _current_timings.set(self.timings)
+        return self.timings
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_timings.reset(self.token)
+        return False
+
+
+def stage(name):
+    timings = _current_timings.get()
+    if timings is None:
+        return _NULL_STAGE
+    return _Stage(timings, name)
+
+
+def log_request(event, timings, **fields):
+    fields.update(timings.as_fields())
+    structured_logger.log(logging.INFO, event, fields)
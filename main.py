@@ -1,196 +1,917 @@
-from flask import Flask, render_template, request, jsonify
-import requests
-import os
-import base64
-from google.oauth2 import service_account
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Blueprint, Flask, Request, Response, render_template, request, jsonify
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from werkzeug.routing import BaseConverter
 import json
+import math
+import os
+
+import logs
+import metrics
+from auth import credential_provider
+from cache import image_digest, make_cache_key, make_result_cache
+from calorie_db import make_calorie_db
+from image_utils import ImageData
+from jobs import JobQueue, JobQueueFull, make_job_store
+from phash import HashIndex, dhash_with_size
+from preprocess import make_preprocessor
+from ratelimit import PRIORITY_BATCH, RateLimitExceeded, request_priority
+from schema import (CalorieResult, Dish, ResultParseError, StreamParser, extract_json, extract_text,
+                    parse_response)
+from singleflight import FlightAbandoned, SingleFlight
+from upstream import UpstreamTimeout, iter_sse_data, upstream_client
+
+VISION_MODEL = 'gemini-pro-vision'
+GENERATE_MODEL = 'gemini-pro'
+VISION_PATH = f'models/{VISION_MODEL}:generateContent'
+GENERATE_PATH = f'models/{GENERATE_MODEL}:generateContent'
+
+# 1回の呼び出しで料理・調理法・カロリーまで出すマルチモーダルモデル
+ANALYZE_MODEL = os.getenv('ANALYZE_MODEL', 'gemini-1.5-flash')
+ANALYZE_PATH = f'models/{ANALYZE_MODEL}:generateContent'
+# /analyze/stream 用。生成されたテキストを少しずつSSEで受け取る
+ANALYZE_STREAM_PATH = f'models/{ANALYZE_MODEL}:streamGenerateContent?alt=sse'
+
+# single: ANALYZE_MODELを1回呼ぶ / two_step: Vision API → Generate API の2段階
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'single')
+if PIPELINE_MODE not in ('single', 'two_step'):
+    raise ValueError(f'不明なPIPELINE_MODEです: {PIPELINE_MODE}')
+
+# プロンプトやレスポンス形式を変更したら上げる（結果キャッシュのキーに含まれる）
+PROMPT_VERSION = 4
+
+# ANALYZE_STREAM_PROMPT を変更したら上げる
+STREAM_PROMPT_VERSION = 1
+
+# パイプラインの構成が変わったら別のキャッシュキーにする
+if PIPELINE_MODE == 'single':
+    PIPELINE_CACHE_PARTS = (f'v{PROMPT_VERSION}', PIPELINE_MODE, ANALYZE_MODEL)
+else:
+    PIPELINE_CACHE_PARTS = (f'v{PROMPT_VERSION}', PIPELINE_MODE, VISION_MODEL, GENERATE_MODEL)
+# /analyze/stream は別のプロンプトで結果を作るので、/analyze の結果とは共有しない
+STREAM_CACHE_PARTS = (f'v{STREAM_PROMPT_VERSION}', 'stream', ANALYZE_MODEL)
+
+# 送信待ちが一杯でGemini APIを呼べなかった場合のメッセージ
+RATE_LIMITED_MESSAGE = 'Gemini APIが混み合っています。しばらくしてから再度お試しください'
+
+# バイナリのまま受け付けるContent-Type
+RAW_UPLOAD_TYPES = frozenset(('application/octet-stream', 'image/jpeg', 'image/png'))
+
+# 参照表で引けるよう、料理名と分量を構造化して出力させる
+VISION_PROMPT = (
+    'この写真に写っている料理を分析し、料理ごとに料理名、調理法、分量、使われている主な食材を'
+    '次の形式のJSONで出力してください：\n'
+    '{"dishes": [{"name": "料理名", "cooking_method": "調理法", '
+    '"portion": "分量（例: 茶碗1杯、4個、大盛り）", "ingredients": "主な食材"}]}'
+)
+
+ANALYZE_PROMPT = (
+    'この写真に写っている食事を分析してください。'
+    '料理ごとに料理名、推定カロリー(kcal)、調理法、分量を推定し、献立全体の合算カロリーも求めてください。'
+    '結果は指定したJSONスキーマに従って出力してください。'
+)
+
+# 料理ごとに1行ずつ出力させ、行がそろった料理から画面に出す
+ANALYZE_STREAM_PROMPT = (
+    'この写真に写っている食事を分析してください。'
+    '料理ごとに1行ずつ、次の形式のJSONを出力してください：\n'
+    '{"name": "料理名", "kcal": 数値, "cooking_method": "調理法", "portion": "分量"}\n'
+    '最後の行には献立全体の合算カロリーを {"total_kcal": 数値} の形式で出力してください。'
+    'JSON以外の文章やコードブロックの記号は出力しないでください。'
+)
+
+GENERATE_PROMPT = (
+    '画像から分析した食事内容に基づいて、各料理の名前、推定カロリー(kcal)、調理法、分量と、'
+    '献立全体の合算カロリーを推定してください。\n'
+    '次の形式のJSONのみを出力してください：\n'
+    '{"dishes": [{"name": "料理名", "kcal": 数値, "cooking_method": "調理法", "portion": "分量"}], '
+    '"total_kcal": 数値}\n\n'
+    '分析結果：'
+)
+
+# 構造化出力のスキーマ（generationConfig.responseSchema）
+ANALYZE_RESPONSE_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'dishes': {
+            'type': 'ARRAY',
+            'items': {
+                'type': 'OBJECT',
+                'properties': {
+                    'name': {'type': 'STRING'},
+                    'kcal': {'type': 'NUMBER'},
+                    'cooking_method': {'type': 'STRING'},
+                    'portion': {'type': 'STRING'},
+                },
+                'required': ['name', 'kcal'],
+            },
+        },
+        'total_kcal': {'type': 'NUMBER'},
+    },
+    'required': ['dishes', 'total_kcal'],
+}
+
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+
+# ルートは create_app() でアプリに登録する
+routes = Blueprint('calcam', __name__)
+
+# /analyze/batch の同時処理数と1回あたりの上限枚数
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 100))
+# /analyze/batch のリクエスト全体の上限（1枚あたりの上限は MAX_UPLOAD_BYTES）
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 200 * 1024 * 1024))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+
+# 同じ画像の再送信はGemini APIを呼ばずに結果を返す
+result_cache = make_result_cache()
 
-app = Flask(__name__)
+# 撮り直した写真も拾えるよう、知覚ハッシュで近い画像の結果を再利用する（負の値で無効。既定は無効）
+# 9x8画素に縮小したハッシュは同じトレーやテーブルの別の料理でも一致するので、
+# 画像の大きさとバイト数も近い場合だけ再利用する
+NEAR_DUPLICATE_DISTANCE = int(os.getenv('NEAR_DUPLICATE_DISTANCE', -1))
+NEAR_DUPLICATE_SIZE_TOLERANCE = float(os.getenv('NEAR_DUPLICATE_SIZE_TOLERANCE', 0.1))
+NEAR_DUPLICATE_MAX_ENTRIES = int(os.getenv('NEAR_DUPLICATE_MAX_ENTRIES', 200000))
+# /analyze と /analyze/stream の結果が混ざらないよう、キャッシュキーの構成ごとに索引を分ける
+near_duplicate_indexes = {
+    cache_parts: HashIndex(max_entries=NEAR_DUPLICATE_MAX_ENTRIES)
+    for cache_parts in (PIPELINE_CACHE_PARTS, STREAM_CACHE_PARTS)
+}
 
-@app.route('/')
+# 同じ画像が同時に届いた場合（連打や再送）はGemini APIの呼び出しを1回にまとめる
+inflight = SingleFlight()
+
+# Vision APIが挙げた料理がすべて参照表にあれば、Generate APIを呼ばずにカロリーを計算する
+calorie_db = make_calorie_db()
+
+# Prefer: respond-async のリクエストを処理するワーカー数（0にするとjobs.pyのワーカーに任せる）
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+
+# Vision APIに送る前に画像を縮小・再圧縮する（PREPROCESS_MAX_EDGE=0で無効）
+preprocessor = make_preprocessor()
+
+def prepare_image(image):
+    if preprocessor is None:
+        return image
+    try:
+        data, mime_type = preprocessor.run(image.raw)
+    except Exception as e:
+        logs.warning('preprocess_failed', error=str(e))
+        return image
+    if mime_type is None:
+        return image
+    return ImageData(raw=data, mime_type=mime_type)
+
+def find_near_duplicate(image_signature, cache_parts=PIPELINE_CACHE_PARTS):
+    if image_signature is None:
+        return None
+    image_hash, dimensions, size = image_signature
+    match = near_duplicate_indexes[cache_parts].search(image_hash, NEAR_DUPLICATE_DISTANCE)
+    if match is None:
+        return None
+    cache_key, match_dimensions, match_size = match[0]
+    if match_dimensions != dimensions:
+        return None
+    if abs(match_size - size) > NEAR_DUPLICATE_SIZE_TOLERANCE * max(match_size, size):
+        return None
+    return result_cache.get(cache_key)
+
+def compute_image_signature(image):
+    # (知覚ハッシュ, (幅, 高さ), バイト数) を返す
+    if NEAR_DUPLICATE_DISTANCE < 0:
+        return None
+    try:
+        image_hash, dimensions = dhash_with_size(image.raw)
+    except Exception as e:
+        logs.warning('image_hash_failed', error=str(e))
+        return None
+    return image_hash, dimensions, image.size
+
+@routes.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/analyze', methods=['POST'])
+def load_request_image(req):
+    content_type = req.mimetype
+    
+    # multipart/form-data: imageフィールドのファイルを1つのバッファに読み込む
+    if content_type == 'multipart/form-data':
+        upload = req.files.get('image')
+        if upload is None:
+            raise ValueError('画像データが含まれていません')
+        return ImageData.from_bytes(upload.read())
+    
+    # application/octet-stream など: リクエストボディをそのまま画像として扱う
+    if content_type in RAW_UPLOAD_TYPES:
+        return ImageData.from_bytes(read_request_body(req))
+    
+    # 互換性のためJSONのデータURLも受け付ける
+    data = None
+    if req.is_json:
+        try:
+            data = json.loads(read_request_body(req))
+        except ValueError:
+            pass
+    if not isinstance(data, dict) or 'image' not in data:
+        raise ValueError('画像データが含まれていません')
+    return ImageData.from_data_url(data['image'])
+
+def read_request_body(req):
+    # get_data() と get_json() は MAX_CONTENT_LENGTH を確認しないので、上限を1バイト超えるところまでだけ読む
+    if req.content_length is not None and req.content_length > MAX_UPLOAD_BYTES:
+        raise RequestEntityTooLarge()
+    body = req.stream.read(MAX_UPLOAD_BYTES + 1)
+    if len(body) > MAX_UPLOAD_BYTES:
+        raise RequestEntityTooLarge()
+    return body
+
+def lookup_cached_result(image, cache_parts=PIPELINE_CACHE_PARTS):
+    # 完全一致の結果キャッシュ、次に知覚ハッシュによる近似重複を確認する
+    cache_key = make_cache_key(image_digest(image.raw), *cache_parts)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cache_key, None, cached, 'HIT'
+    
+    image_signature = compute_image_signature(image)
+    cached = find_near_duplicate(image_signature, cache_parts)
+    if cached is not None:
+        return cache_key, image_signature, cached, 'NEAR'
+    return cache_key, image_signature, None, 'MISS'
+
+def store_result(cache_key, image_signature, result, cache_parts=PIPELINE_CACHE_PARTS):
+    # 成功した結果のみキャッシュする
+    result_cache.set(cache_key, result)
+    if image_signature is not None:
+        image_hash, dimensions, size = image_signature
+        near_duplicate_indexes[cache_parts].add(image_hash, (cache_key, dimensions, size))
+
+def analyze_uncached(cache_key, image_signature, image):
+    # 同じ画像の処理を待っている間に結果がキャッシュされていればそれを使う
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    with logs.stage('preprocess'):
+        image = prepare_image(image)
+    
+    # Gemini APIを呼び出し
+    result = run_pipeline(image)
+    if not isinstance(result, tuple):
+        store_result(cache_key, image_signature, result)
+    return result
+
+def analyze_image(image):
+    # 1枚の画像を分析して (レスポンス本文, ステータスコード, キャッシュ状態) を返す
+    metrics.image_bytes.observe(image.size)
+    with logs.stage('cache'):
+        cache_key, image_signature, cached, cache_status = lookup_cached_result(image)
+    if cached is not None:
+        return cached, 200, cache_status
+    
+    result, shared = inflight.do(cache_key, analyze_uncached, cache_key, image_signature, image)
+    if isinstance(result, tuple):
+        error_body, status_code = result
+        return error_body, status_code, None
+    return result, 200, 'COALESCED' if shared else cache_status
+
+@routes.route('/analyze', methods=['POST'])
 def analyze():
+    with logs.timed_request() as timings:
+        response = analyze_request()
+        logs.log_request('analyze', timings, status=response.status_code,
+                         cache=response.headers.get('X-Cache'),
+                         request_bytes=request.content_length)
+        metrics.observe_request('analyze', response.status_code, timings,
+                                response.headers.get('X-Cache'))
+        return response
+
+def retry_after_header(seconds):
+    # Retry-Afterは整数の秒数で返す
+    return str(max(1, math.ceil(seconds)))
+
+def wants_async(req):
+    # ?async=1 または Prefer: respond-async ならジョブとして受け付けてすぐに返す
+    if req.args.get('async') in ('1', 'true'):
+        return True
+    return 'respond-async' in req.headers.get('Prefer', '')
+
+def enqueue_job(image):
+    try:
+        job_id = job_queue.submit(image)
+    except JobQueueFull as e:
+        response = jsonify({'error': str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = retry_after_header(job_queue.poll_interval)
+        return response
+    response = jsonify({'id': job_id, 'status': 'queued'})
+    response.status_code = 202
+    response.headers['Location'] = f'/analyze/{job_id}'
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
+def analyze_request():
     try:
         # 画像データを取得
-        data = request.get_json()
-        if not data or 'image' not in data:
-            raise ValueError('画像データが含まれていません')
-            
-        # Base64エンコードされた画像データの処理
-        image_data = data['image']
-        if not image_data.startswith('data:image/jpeg;base64,'):
-            raise ValueError('無効な画像データ形式')
-            
-        # データURLのプレフィックスを削除
-        base64_data = image_data.split(',')[1]
-        
-        # パディングを追加
-        padding_needed = len(base64_data) % 4
-        if padding_needed:
-            base64_data += '=' * (4 - padding_needed)
-        
-        # URLエンコードされた文字をデコード
-        base64_data = base64_data.replace('-', '+').replace('_', '/')
-        
-        # Gemini Vision APIを呼び出し
-        vision_response = call_vision_api(base64_data)
+        with logs.stage('decode'):
+            try:
+                image = load_request_image(request)
+            except ValueError as e:
+                # 画像データの誤りはクライアント側のエラー
+                response = jsonify({'error': str(e)})
+                response.status_code = 400
+                return response
         
-        # Gemini Generate APIを呼び出し
-        generate_response = call_generate_api(vision_response)
+        if wants_async(request):
+            with logs.stage('enqueue'):
+                return enqueue_job(image)
         
-        return jsonify(generate_response)
+        body, status_code, cache_status = analyze_image(image)
+        with logs.stage('serialize'):
+            response = jsonify(body)
+        response.status_code = status_code
+        if cache_status:
+            response.headers['X-Cache'] = cache_status
+        return response
+    except HTTPException as e:
+        response = jsonify({'error': e.description})
+        response.status_code = e.code
+        return response
+    except UpstreamTimeout as e:
+        response = jsonify({'error': f'Gemini APIの応答がタイムアウトしました: {str(e)}'})
+        response.status_code = 504
+        return response
+    except RateLimitExceeded as e:
+        response = jsonify({'error': RATE_LIMITED_MESSAGE})
+        response.status_code = 503
+        response.headers['Retry-After'] = retry_after_header(e.retry_after)
+        return response
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        logs.error('analyze_failed', error=str(e))
+        response = jsonify({'error': str(e)})
+        response.status_code = 500
+        return response
 
-def call_vision_api(base64_data):
+def check_item_size(image):
+    # バッチ内の1枚ごとに /analyze と同じ上限を適用する
+    if image.size > MAX_UPLOAD_BYTES:
+        raise ValueError(f'画像のサイズが大きすぎます（1枚あたり{MAX_UPLOAD_BYTES}バイトまで）')
+    return image
+
+def load_batch_items(req):
+    # (ID, 画像またはエラー) の一覧を返す。1枚の不正な画像でバッチ全体を失敗させない
+    # NDJSONは get_data() で読むので、フォームの解析に任せずここで全体の大きさを確認する
+    if req.content_length is not None and req.content_length > BATCH_MAX_BYTES:
+        raise RequestEntityTooLarge()
+    items = []
+    if req.mimetype == 'multipart/form-data':
+        for index, upload in enumerate(req.files.getlist('images')):
+            try:
+                image = ImageData.from_bytes(upload.read(MAX_UPLOAD_BYTES + 1))
+                items.append((upload.filename or str(index), check_item_size(image)))
+            except ValueError as e:
+                items.append((upload.filename or str(index), e))
+    elif req.mimetype == 'application/x-ndjson':
+        # 1行に1つ {"id": ..., "image": "data:image/jpeg;base64,..."}
+        for index, line in enumerate(req.get_data(cache=False).splitlines()):
+            if not line.strip():
+                continue
+            item_id = str(index)
+            try:
+                data = json.loads(line)
+                if not isinstance(data, dict) or 'image' not in data:
+                    raise ValueError('画像データが含まれていません')
+                item_id = str(data.get('id', index))
+                items.append((item_id, check_item_size(ImageData.from_data_url(data['image']))))
+            except ValueError as e:
+                items.append((item_id, e))
+    else:
+        raise ValueError('multipart/form-data または application/x-ndjson で送信してください')
+    
+    if not items:
+        raise ValueError('画像データが含まれていません')
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f'1回のバッチで送信できる画像は{BATCH_MAX_ITEMS}枚までです')
+    return items
+
+def analyze_batch_item(index, item_id, image):
+    # 画面からの /analyze を先に送れるよう、バッチは低い優先度でGemini APIを呼ぶ
+    with logs.timed_request() as timings, request_priority(PRIORITY_BATCH):
+        line = run_batch_item(index, item_id, image)
+        logs.log_request('analyze_batch_item', timings, status=line['status'], cache=line.get('cache'))
+        metrics.observe_request('analyze_batch_item', line['status'], timings, line.get('cache'))
+        return line
+
+def analyze_safely(image):
+    # analyze_image の例外をエラーのレスポンス本文とステータスコードに変換する
     try:
-        print(f"=== Vision APIリクエスト詳細 ===")
-        print(f"Base64データサイズ: {len(base64_data)}バイト")
-        print(f"パディング前のデータ長: {len(base64_data) % 4}")
-        
-        # Base64データのバリデーションと正規化
-        if not base64_data:
-            raise ValueError('Base64データが空です')
-            
-        # URLエンコードされた文字を置換（Gemini API仕様に合わせる）
-        base64_data = base64_data.replace('-', '+').replace('_', '/')
-        
-        # パディングを追加（必要に応じて）
-        padding_needed = len(base64_data) % 4
-        if padding_needed:
-            base64_data += '=' * (4 - padding_needed)
-            
-        # Base64データをバイナリにデコードして再エンコード
+        if isinstance(image, Exception):
+            raise image
+        return analyze_image(image)
+    except ValueError as e:
+        return {'error': str(e)}, 400, None
+    except UpstreamTimeout as e:
+        return {'error': f'Gemini APIの応答がタイムアウトしました: {str(e)}'}, 504, None
+    except RateLimitExceeded:
+        return {'error': RATE_LIMITED_MESSAGE}, 503, None
+    except Exception as e:
+        return {'error': str(e)}, 500, None
+
+def run_batch_item(index, item_id, image):
+    line = {'index': index, 'id': item_id}
+    body, status_code, cache_status = analyze_safely(image)
+    
+    line['status'] = status_code
+    if status_code == 200:
+        line['result'] = body
+        line['cache'] = cache_status
+    else:
+        line['error'] = body.get('error')
+    return line
+
+@routes.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    try:
+        items = load_batch_items(request)
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    
+    futures = [
+        batch_executor.submit(analyze_batch_item, index, item_id, image)
+        for index, (item_id, image) in enumerate(items)
+    ]
+    
+    def generate():
+        # 終わった画像から順にNDJSONで返す
         try:
-            binary_data = base64.b64decode(base64_data)
-            # 画像データの形式を確認
-            if not binary_data.startswith((b'\xff\xd8', b'\x89PNG')):
-                raise ValueError('サポートされていない画像形式です')
-            
-            # 再エンコード
-            base64_data = base64.b64encode(binary_data).decode('utf-8')
-            print(f"Base64データ長: {len(base64_data)}バイト")
-            
+            for future in as_completed(futures):
+                yield json.dumps(future.result(), ensure_ascii=False) + '\n'
+        finally:
+            # クライアントが切断した場合は未着手の画像を取り消す
+            for future in futures:
+                future.cancel()
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def run_job(job_id, image):
+    # ジョブキューのワーカーから呼ばれる。(レスポンス本文, ステータスコード) を返す
+    # 画面からの /analyze を先に送れるよう、バッチと同じ低い優先度でGemini APIを呼ぶ
+    with logs.timed_request() as timings, request_priority(PRIORITY_BATCH):
+        body, status_code, cache_status = analyze_safely(image)
+        logs.log_request('analyze_job', timings, status=status_code, cache=cache_status, job_id=job_id)
+        metrics.observe_request('analyze_job', status_code, timings, cache_status)
+        return body, status_code
+
+# /analyze?async=1 で受け付けたジョブ（JOB_BACKEND=sqlite なら別プロセスのワーカーとも共有する）
+job_queue = JobQueue(make_job_store(), run_job, workers=JOB_WORKERS)
+
+@routes.route('/analyze/<job_id:job_id>', methods=['GET'])
+def analyze_job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    response = jsonify(job)
+    if job['status'] in ('queued', 'running'):
+        # ポーリング間隔の目安
+        response.headers['Retry-After'] = '1'
+    return response
+
+def sse_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+def result_events(result):
+    # パイプラインの結果（成功なら dict、失敗なら (エラー本文, ステータスコード)）をイベントにする
+    if isinstance(result, tuple):
+        error_body, status_code = result
+        yield 'error', {'error': error_body['error'], 'status': status_code}
+        return
+    for dish in result['dishes']:
+        yield 'dish', dish
+    yield 'total', result
+
+def stream_analysis(image):
+    # (イベント名, データ) を順に返す。料理は行がそろうたびに、最後に合計を含む結果全体を返す
+    # モデルが使えない場合や応答を解析できない場合は /analyze と同じく2段階の処理に切り替える
+    # （送り済みの料理は total イベントの結果全体で置き換えられる）
+    response = post_upstream(
+        ANALYZE_STREAM_PATH, build_analyze_stream_payload(image), 'analyze', stream=True)
+    if response.status_code != 200:
+        result = handle_vision_response(response, 'Analyze API')
+        if should_fall_back(result):
+            logs.warning('pipeline_fallback', reason='upstream_error', status=result[1])
+            result = run_two_step(image)
+        yield from result_events(result)
+        return
+    
+    parser = StreamParser()
+    try:
+        with logs.stage('stream'):
+            try:
+                for chunk in iter_sse_data(response):
+                    try:
+                        text = extract_text(chunk)
+                    except ResultParseError:
+                        # 最後のチャンクなどテキストを含まないものは読み飛ばす
+                        continue
+                    for dish in parser.feed(text):
+                        yield 'dish', dish.to_dict()
+            finally:
+                response.close()
+        result = parser.close().to_dict()
+    except ResultParseError as e:
+        logs.warning('pipeline_fallback', reason='parse_error', error=str(e))
+        yield from result_events(run_two_step(image))
+        return
+    yield 'total', result
+
+def lead_stream(cache_key, image_signature, image, call):
+    # 同じ画像を待っている他のリクエストに、ストリームの最後に結果を渡す
+    result = FlightAbandoned('最初のリクエストが分析を終える前に切断されました')
+    try:
+        # stream_events() がここまで進めておくので、送り始める前に閉じられても finally が動く
+        yield
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            result = cached
+            yield from result_events(cached)
+            return
+
+        with logs.stage('preprocess'):
+            prepared = prepare_image(image)
+        for event, data in stream_analysis(prepared):
+            if event == 'total':
+                store_result(cache_key, image_signature, data, STREAM_CACHE_PARTS)
+                result = data
+            elif event == 'error':
+                result = {'error': data['error']}, data['status']
+            yield event, data
+    except Exception as e:
+        result = e
+        raise
+    finally:
+        if isinstance(result, BaseException):
+            inflight.finish(cache_key, call, error=result)
+        else:
+            inflight.finish(cache_key, call, result)
+
+def stream_events(image):
+    # (イベントの列, キャッシュ状態) を返す
+    if PIPELINE_MODE == 'two_step':
+        # 2段階の処理は途中の結果を返せないので、/analyze と同じ処理の結果をまとめて送る
+        body, status_code, cache_status = analyze_image(image)
+        return result_events(body if status_code == 200 else (body, status_code)), cache_status
+
+    with logs.stage('cache'):
+        cache_key, image_signature, cached, cache_status = lookup_cached_result(
+            image, STREAM_CACHE_PARTS)
+    if cached is not None:
+        return result_events(cached), cache_status
+
+    # 連打などで同じ画像が同時に届いた場合は、最初のリクエストのストリームの結果をまとめて送る
+    while True:
+        call, leader = inflight.begin(cache_key)
+        if leader:
+            events = lead_stream(cache_key, image_signature, image, call)
+            next(events)
+            return events, cache_status
+        try:
+            result = inflight.wait(call)
+        except FlightAbandoned:
+            # 最初のリクエストが切断された場合は、このリクエストが代わりに分析する
+            continue
+        return result_events(result), 'COALESCED'
+
+def stream_error(e):
+    # 分析中の例外を error イベントのデータにする
+    if isinstance(e, ResultParseError):
+        return {'error': f'分析結果を解析できませんでした: {str(e)}', 'status': 502}
+    if isinstance(e, UpstreamTimeout):
+        return {'error': f'Gemini APIの応答がタイムアウトしました: {str(e)}', 'status': 504}
+    if isinstance(e, RateLimitExceeded):
+        return {'error': RATE_LIMITED_MESSAGE, 'status': 503}
+    logs.error('analyze_failed', error=str(e))
+    return {'error': str(e), 'status': 500}
+
+@routes.route('/analyze/stream', methods=['POST'])
+def analyze_stream():
+    # レスポンスを返した後もストリームを送り終えるまで同じリクエストとして計測する
+    # PIPELINE_MODE=two_step の場合は料理を1つずつではなく、結果全体をまとめて送る
+    timings = logs.StageTimings()
+    try:
+        with timings.stage('decode'):
+            image = load_request_image(request)
+    except Exception as e:
+        status = e.code if isinstance(e, HTTPException) else 400
+        logs.log_request('analyze_stream', timings, status=status)
+        metrics.observe_request('analyze_stream', status, timings)
+        return jsonify({'error': e.description if isinstance(e, HTTPException) else str(e)}), status
+
+    # キャッシュの確認や同じ画像の結果待ちはヘッダーを返す前に行い、X-Cache に入れる
+    with logs.timed_request(timings):
+        try:
+            events, cache_status = stream_events(image)
         except Exception as e:
-            raise ValueError(f'Base64データの処理に失敗しました: {str(e)}')
-        
-        # サービスアカウント認証
-        service_account_info = os.getenv('GOOGLE_SERVICE_ACCOUNT_INFO')
-        if not service_account_info:
-            raise ValueError('GOOGLE_SERVICE_ACCOUNT_INFO環境変数が設定されていません')
-        
-        credentials_dict = json.loads(service_account_info)
-        credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-        
-        # APIリクエスト
-        response = requests.post(
-            'https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:generateContent',
+            error = stream_error(e)
+            events, cache_status = result_events(({'error': error['error']}, error['status'])), None
+
+    def generate():
+        # 料理が1つ分かるたびに送る（Server-Sent Events）
+        status, first_dish_ms = 200, None
+        with logs.timed_request(timings):
+            try:
+                for event, data in events:
+                    if event == 'dish' and first_dish_ms is None:
+                        first_dish_ms = round(timings.total() * 1000, 2)
+                    elif event == 'error':
+                        status = data['status']
+                    yield sse_event(event, data)
+            except Exception as e:
+                error = stream_error(e)
+                status = error['status']
+                yield sse_event('error', error)
+            finally:
+                logs.log_request('analyze_stream', timings, status=status, cache=cache_status,
+                                 first_dish_ms=first_dish_ms)
+                metrics.observe_request('analyze_stream', status, timings, cache_status)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if cache_status:
+        headers['X-Cache'] = cache_status
+    response = Response(generate(), mimetype='text/event-stream', headers=headers)
+    # クライアントが切断した場合も、待っている同じ画像のリクエストに知らせる
+    response.call_on_close(events.close)
+    return response
+
+@routes.route('/metrics')
+def metrics_endpoint():
+    # Prometheus のテキスト形式
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+def should_fall_back(result):
+    # モデルが使えない等のクライアントエラーは2段階の処理で再試行する
+    if not isinstance(result, tuple):
+        return False
+    status_code = result[1]
+    return 400 <= status_code < 500 and status_code != 429
+
+def parse_single_result(result):
+    # 1回呼び出しの結果を解析する。2段階の処理に切り替える場合は None を返す
+    if isinstance(result, tuple):
+        if not should_fall_back(result):
+            return result
+        logs.warning('pipeline_fallback', reason='upstream_error', status=result[1])
+        return None
+    try:
+        return parse_response(result).to_dict()
+    except ResultParseError as e:
+        logs.warning('pipeline_fallback', reason='parse_error', error=str(e))
+        return None
+
+def parse_generate_result(generate_response):
+    try:
+        return parse_response(generate_response).to_dict()
+    except ResultParseError as e:
+        return {'error': f'分析結果を解析できませんでした: {str(e)}'}, 502
+
+def estimate_locally(vision_response):
+    # 参照表にない料理が1つでもあれば None を返す（Generate APIで推定する）
+    if calorie_db is None:
+        return None
+    try:
+        items = extract_json(extract_text(vision_response)).get('dishes')
+    except ResultParseError:
+        return None
+    if not isinstance(items, list) or not items:
+        return None
+    
+    dishes = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('name'), str):
+            return None
+        name = item['name'].strip()
+        portion = str(item.get('portion') or '').strip()
+        entry = calorie_db.lookup(name)
+        if entry is None:
+            metrics.local_estimates_total.labels('miss').inc()
+            logs.debug('local_estimate_miss', dish=name)
+            return None
+        dishes.append(Dish(
+            name,
+            int(round(entry.scale(portion))),
+            str(item.get('cooking_method') or '').strip() or entry.cooking_method,
+            portion or entry.portion,
+        ))
+    
+    metrics.local_estimates_total.labels('hit').inc()
+    return CalorieResult(dishes, sum(dish.kcal for dish in dishes)).to_dict()
+
+def run_pipeline(image):
+    if PIPELINE_MODE == 'single':
+        result = parse_single_result(call_analyze_api(image))
+        if result is not None:
+            return result
+    return run_two_step(image)
+
+def run_two_step(image):
+    # Gemini Vision APIを呼び出し
+    vision_response = call_vision_api(image)
+    if isinstance(vision_response, tuple):
+        return vision_response
+    
+    with logs.stage('local_estimate'):
+        result = estimate_locally(vision_response)
+    if result is not None:
+        return result
+    
+    # Gemini Generate APIを呼び出し
+    return parse_generate_result(call_generate_api(vision_response))
+
+def build_analyze_payload(image):
+    return {
+        'contents': [{
+            'parts': [
+                {'text': ANALYZE_PROMPT},
+                {
+                    'inlineData': {
+                        'mimeType': image.mime_type,
+                        'data': image.b64
+                    }
+                }
+            ]
+        }],
+        'generationConfig': {
+            'temperature': 0.4,
+            'responseMimeType': 'application/json',
+            'responseSchema': ANALYZE_RESPONSE_SCHEMA
+        }
+    }
+
+def build_analyze_stream_payload(image):
+    return {
+        'contents': [{
+            'parts': [
+                {'text': ANALYZE_STREAM_PROMPT},
+                {
+                    'inlineData': {
+                        'mimeType': image.mime_type,
+                        'data': image.b64
+                    }
+                }
+            ]
+        }],
+        'generationConfig': {
+            'temperature': 0.4
+        }
+    }
+
+def post_upstream(path, payload, stage_name, stream=False):
+    # サービスアカウント認証（プロセス全体でキャッシュ）
+    with logs.stage('credentials'):
+        token = credential_provider.get_token()
+    
+    with logs.stage(stage_name):
+        post = upstream_client.post_stream if stream else upstream_client.post_json
+        return post(
+            path,
+            payload,
             headers={
-                'Authorization': f'Bearer {credentials.token}',
+                'Authorization': f'Bearer {token}',
                 'Content-Type': 'application/json'
-            },
-            json={
-                'contents': [{
+            }
+        )
+
+def call_analyze_api(image):
+    try:
+        logs.debug('upstream_request', api='analyze', mime_type=image.mime_type, image_bytes=image.size)
+        response = post_upstream(ANALYZE_PATH, build_analyze_payload(image), 'analyze')
+        return handle_vision_response(response, 'Analyze API')
+    except Exception as e:
+        logs.warning('upstream_call_failed', api='analyze', error=str(e))
+        raise
+
+def build_vision_payload(image):
+    return {
+        'contents': [{
+            'parts': [
+                {'text': VISION_PROMPT},
+                {
                     'inlineData': {
-                        'mimeType': 'image/jpeg',
-                        'data': base64_data
+                        'mimeType': image.mime_type,
+                        # Base64エンコードはここで一度だけ行われる
+                        'data': image.b64
                     }
-                }],
-                'generationConfig': {
-                    'temperature': 0.7
                 }
+            ]
+        }],
+        'generationConfig': {
+            'temperature': 0.7
+        }
+    }
+
+def handle_vision_response(response, api_name='Vision API'):
+    if response.status_code != 200:
+        try:
+            error_data = response.json()
+            
+            error_details = {
+                'code': error_data.get('error', {}).get('code'),
+                'status': error_data.get('error', {}).get('status'),
+                'message': error_data.get('error', {}).get('message'),
+                'details': error_data.get('error', {}).get('details')
             }
-        )
-        
-        print(f"=== APIレスポンス ===")
-        print(f"ステータスコード: {response.status_code}")
-        print(f"レスポンスヘッダー: {dict(response.headers)}")
-        
-        if response.status_code != 200:
-            print(f"=== レスポンス詳細 ===")
-            print(f"ステータスコード: {response.status_code}")
-            print(f"レスポンスヘッダー: {dict(response.headers)}")
-            print(f"レスポンスボディ: {response.text}")
+            logs.warning('upstream_error', api=api_name, status_code=response.status_code,
+                         code=error_details['code'], status=error_details['status'],
+                         message=error_details['message'])
             
-            try:
-                error_data = response.json()
-                print(f"=== レスポンスJSON ===")
-                print(json.dumps(error_data, indent=2))
-                
-                error_details = {
-                    'code': error_data.get('error', {}).get('code'),
-                    'status': error_data.get('error', {}).get('status'),
-                    'message': error_data.get('error', {}).get('message'),
-                    'details': error_data.get('error', {}).get('details')
-                }
-                
-                error_message = f"Vision APIエラー: {error_details['message']}\n" \
-                             f"ステータス: {error_details['status']}\n" \
-                             f"コード: {error_details['code']}"
-                
-                return {'error': error_message}, response.status_code
-                
-            except Exception as e:
-                error_message = f"Vision APIエラー: レスポンスの解析に失敗しました\n" \
-                             f"ステータスコード: {response.status_code}\n" \
-                             f"レスポンス: {response.text[:1000]}..."
-                return {'error': error_message}, response.status_code
-        
-        return response.json()
-        
+            error_message = f"{api_name}エラー: {error_details['message']}\n" \
+                         f"ステータス: {error_details['status']}\n" \
+                         f"コード: {error_details['code']}"
+            
+            metrics.upstream_errors_total.labels(api_name, error_details['code'] or response.status_code).inc()
+            return {'error': error_message}, response.status_code
+            
+        except Exception as e:
+            metrics.upstream_errors_total.labels(api_name, response.status_code).inc()
+            logs.warning('upstream_error', api=api_name, status_code=response.status_code,
+                         body=response.text[:200])
+            error_message = f"{api_name}エラー: レスポンスの解析に失敗しました\n" \
+                         f"ステータスコード: {response.status_code}\n" \
+                         f"レスポンス: {response.text[:1000]}..."
+            return {'error': error_message}, response.status_code
+    
+    return response.json()
+
+def call_vision_api(image):
+    try:
+        logs.debug('upstream_request', api='vision', mime_type=image.mime_type, image_bytes=image.size)
+        response = post_upstream(VISION_PATH, build_vision_payload(image), 'vision')
+        return handle_vision_response(response)
     except Exception as e:
-        print(f"=== エラー詳細 ===")
-        print(f"エラー: {str(e)}")
+        logs.warning('upstream_call_failed', api='vision', error=str(e))
         raise
 
+def build_generate_payload(vision_response):
+    # Visionのレスポンス全体ではなく、分析結果のテキストだけを渡す
+    return {
+        'contents': [{
+            'parts': [{
+                'text': GENERATE_PROMPT + extract_text(vision_response)
+            }]
+        }],
+        'generationConfig': {
+            'temperature': 0.4
+        }
+    }
+
+def handle_generate_response(response):
+    if response.status_code != 200:
+        metrics.upstream_errors_total.labels('Generate API', response.status_code).inc()
+        error_data = response.json()
+        error_message = error_data.get('error', {}).get('message', '不明なエラー')
+        logs.warning('upstream_error', api='Generate API', status_code=response.status_code,
+                     code=error_data.get('error', {}).get('code'), message=error_message)
+        raise Exception(f'Generate APIエラー: {error_message}')
+    
+    return response.json()
+
 def call_generate_api(vision_response):
     try:
-        print(f"=== Generate APIリクエスト詳細 ===")
-        print(f"Visionレスポンス: {vision_response}")
-        
-        # サービスアカウント認証
-        service_account_info = os.getenv('GOOGLE_SERVICE_ACCOUNT_INFO')
-        if not service_account_info:
-            raise ValueError('GOOGLE_SERVICE_ACCOUNT_INFO環境変数が設定されていません')
-        
-        credentials_dict = json.loads(service_account_info)
-        credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-        
-        response = requests.post(
-            'https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent',
-            headers={
-                'Authorization': f'Bearer {credentials.token}',
-                'Content-Type': 'application/json'
-            },
-            json={
-                'contents': [{
-                    'parts': [{
-                        'text': f"画像から分析した食事内容に基づいて、以下のような情報を生成してください：\n1. 各料理の名前と推定カロリー\n2. 献立全体の合算カロリー\n3. 調理法の推定\n\n分析結果：{vision_response}"
-                    }]
-                }]
-            }
-        )
-        
-        print(f"=== Generate APIレスポンス ===")
-        print(f"ステータスコード: {response.status_code}")
-        print(f"レスポンスヘッダー: {dict(response.headers)}")
-        
-        if response.status_code != 200:
-            print(f"=== APIエラー詳細 ===")
-            print(f"レスポンスボディ: {response.text}")
-            error_data = response.json()
-            error_message = error_data.get('error', {}).get('message', '不明なエラー')
-            raise Exception(f'Generate APIエラー: {error_message}')
-        
-        return response.json()
-        
+        logs.debug('upstream_request', api='generate')
+        response = post_upstream(GENERATE_PATH, build_generate_payload(vision_response), 'generate')
+        return handle_generate_response(response)
     except Exception as e:
-        print(f"=== エラー詳細 ===")
-        print(f"エラー: {str(e)}")
+        logs.warning('upstream_call_failed', api='generate', error=str(e))
         raise
 
+class JobIdConverter(BaseConverter):
+    """ジョブID（uuid4().hex）だけに一致させ、/analyze/batch などへのGETは405のままにする"""
+
+    regex = '[0-9a-f]{32}'
+
+class UploadRequest(Request):
+    """/analyze/batch だけは複数枚分のリクエストサイズを受け付ける"""
+
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'calcam.analyze_batch':
+            return BATCH_MAX_BYTES
+        return super().max_content_length
+
+def create_app():
+    # google-authやrequestsはここでは読み込まず、最初にGemini APIを呼ぶときに読み込む
+    app = Flask(__name__)
+    app.request_class = UploadRequest
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+    # 日本語をエスケープせずUTF-8のまま返す（レスポンスが約半分になる）
+    app.config['JSON_AS_ASCII'] = False
+    # ルートの登録より前にコンバーターを追加する
+    app.url_map.converters['job_id'] = JobIdConverter
+    app.register_blueprint(routes)
+    return app
+
+# Vercel や gunicorn main:app はこのアプリを使う
+app = create_app()
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,223 @@
+import threading
+from bisect import bisect_left
+
+# 秒単位のレイテンシ用バケット
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 画像サイズ用バケット（バイト）
+SIZE_BUCKETS = (16e3, 32e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6)
+
+# 終了したスレッドの値をまとめる目安のシャード数
+_MAX_SHARDS = 64
+
+
+class _ShardedValues:
+    """スレッドごとに別々のリストへ書き込み、読み出し時に合算する
+
+    書き込みのたびにロックを取らずに済む。ロックを取るのは
+    スレッドの初回書き込み時と集計時だけ。
+    """
+
+    __slots__ = ('size', '_local', '_shards', '_retired', '_lock')
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._shards = []
+        self._retired = [0] * size
+        self._lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            pass
+        values = [0] * self.size
+        with self._lock:
+            self._shards.append((threading.current_thread(), values))
+            if len(self._shards) > _MAX_SHARDS:
+                self._retire_dead()
+        self._local.values = values
+        return values
+
+    def _retire_dead(self):
+        # ロックを保持した状態で呼び出すこと
+        alive = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                for i, value in enumerate(values):
+                    self._retired[i] += value
+        self._shards = alive
+
+    def snapshot(self):
+        with self._lock:
+            self._retire_dead()
+            totals = list(self._retired)
+            for _, values in self._shards:
+                for i, value in enumerate(values):
+                    totals[i] += value
+        return totals
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        # 呼び出し時の値（200 など）のままで引けるようにしておく
+        self._lookup = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._lookup.get(values)
+        if child is None:
+            with self._lock:
+                key = tuple(str(value) for value in values)
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self._new_child()
+                self._lookup[values] = child
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('_values',)
+
+    def __init__(self):
+        self._values = _ShardedValues(1)
+
+    def inc(self, amount=1):
+        self._values.shard()[0] += amount
+
+    def value(self):
+        return self._values.snapshot()[0]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        labels = _format_labels(self.labelnames, values)
+        return [f'{self.name}{labels} {_format_value(child.value())}']
+
+
+class _HistogramChild:
+    __slots__ = ('upper_bounds', '_values')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        # バケットごとの件数、合計値、件数
+        self._values = _ShardedValues(len(upper_bounds) + 2)
+
+    def observe(self, value):
+        values = self._values.shard()
+        values[bisect_left(self.upper_bounds, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def snapshot(self):
+        return self._values.snapshot()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.upper_bounds = tuple(sorted(buckets)) + (float('inf'),)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        snapshot = child.snapshot()
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.upper_bounds, snapshot):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, ('le', _format_value(float(upper_bound))))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f'{self.name}_sum{labels} {_format_value(snapshot[-2])}')
+        lines.append(f'{self.name}_count{labels} {snapshot[-1]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    'calcam_requests_total', '処理したリクエスト数', ('endpoint', 'status')))
+upstream_errors_total = registry.register(Counter(
+    'calcam_upstream_errors_total', 'Gemini APIのエラー数', ('api', 'code')))
+cache_lookups_total = registry.register(Counter(
+    'calcam_cache_lookups_total', '結果キャッシュの参照結果', ('result',)))
+local_estimates_total = registry.register(Counter(
+    'calcam_local_estimates_total', '参照表だけでカロリーを計算できたか', ('result',)))
+image_bytes = registry.register(Histogram(
+    'calcam_image_bytes', 'アップロードされた画像のサイズ（バイト）', buckets=SIZE_BUCKETS))
+stage_duration_seconds = registry.register(Histogram(
+    'calcam_stage_duration_seconds', 'パイプラインの各ステージの所要時間（秒）', ('stage',)))
+
+
+def observe_request(endpoint, status, timings, cache_status=None):
+    requests_total.labels(endpoint, status).inc()
+    if cache_status:
+        cache_lookups_total.labels(cache_status).inc()
+    for name, seconds in timings.stages.items():
+        stage_duration_seconds.labels(name).observe(seconds)
+    stage_duration_seconds.labels('total').observe(timings.total())
@@ -0,0 +1,122 @@
+import io
+import threading
+from collections import deque
+from itertools import combinations
+
+from PIL import Image
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def dhash(raw, hash_size=HASH_SIZE):
+    # 縮小したグレースケール画像の横方向の差分からハッシュを作る
+    return dhash_with_size(raw, hash_size)[0]
+
+
+def dhash_with_size(raw, hash_size=HASH_SIZE):
+    # (ハッシュ, (幅, 高さ)) を返す。ドラフトモードで縮小する前の元の大きさ
+    with Image.open(io.BytesIO(raw)) as img:
+        size = img.size
+        # JPEGはデコード時点で縮小しておく（ドラフトモード）
+        img.draft('L', ((hash_size + 1) * 8, hash_size * 8))
+        gray = img.convert('L').resize((hash_size + 1, hash_size), Image.BOX)
+    # 72画素だけなのでnumpyを使わずに比べる（numpyの読み込みは起動時間の大半を占める）
+    pixels = gray.tobytes()
+    width = hash_size + 1
+    value = 0
+    for start in range(0, len(pixels), width):
+        row = pixels[start:start + width]
+        for left, right in zip(row, row[1:]):
+            value = (value << 1) | (right > left)
+    return value, size
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """マルチインデックスハッシングによるハミング距離検索
+
+    64ビットのハッシュを chunks 個に分割し、それぞれを辞書で引く。
+    距離が r 以下なら少なくとも1つの分割は距離 r // chunks 以下になるので、
+    各分割の近傍だけを調べれば取りこぼしはない。
+    """
+
+    def __init__(self, bits=HASH_BITS, chunks=4, max_entries=None):
+        self.bits = bits
+        self.chunks = chunks
+        self.chunk_bits = bits // chunks
+        self.chunk_mask = (1 << self.chunk_bits) - 1
+        self.max_entries = max_entries
+        self._values = {}
+        self._order = deque()
+        self._tables = [{} for _ in range(chunks)]
+        self._flip_masks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def _split(self, value):
+        return [(value >> (i * self.chunk_bits)) & self.chunk_mask for i in range(self.chunks)]
+
+    def _masks(self, radius):
+        # 分割内で radius ビット以下を反転させるマスクの一覧（初回のみ計算）
+        masks = self._flip_masks.get(radius)
+        if masks is None:
+            masks = [0]
+            for r in range(1, radius + 1):
+                for positions in combinations(range(self.chunk_bits), r):
+                    mask = 0
+                    for position in positions:
+                        mask |= 1 << position
+                    masks.append(mask)
+            self._flip_masks[radius] = masks
+        return masks
+
+    def add(self, value, item):
+        with self._lock:
+            if value not in self._values:
+                for table, chunk in zip(self._tables, self._split(value)):
+                    table.setdefault(chunk, set()).add(value)
+                self._order.append(value)
+            self._values[value] = item
+            if self.max_entries is not None:
+                while len(self._values) > self.max_entries:
+                    self._remove(self._order.popleft())
+
+    def _remove(self, value):
+        del self._values[value]
+        for table, chunk in zip(self._tables, self._split(value)):
+            bucket = table[chunk]
+            bucket.discard(value)
+            if not bucket:
+                del table[chunk]
+
+    def search(self, value, max_distance):
+        # 最も近いエントリの (item, 距離) を返す。見つからなければ None
+        masks = self._masks(max_distance // self.chunks)
+        best = None
+        best_distance = max_distance + 1
+        with self._lock:
+            seen = set()
+            for table, chunk in zip(self._tables, self._split(value)):
+                for mask in masks:
+                    bucket = table.get(chunk ^ mask)
+                    if not bucket:
+                        continue
+                    for candidate in bucket:
+                        if candidate in seen:
+                            continue
+                        seen.add(candidate)
+                        distance = (value ^ candidate).bit_count()
+                        if distance < best_distance:
+                            best = candidate
+                            best_distance = distance
+                            if distance == 0:
+                                return self._values[best], 0
+            if best is None:
+                return None
+            return self._values[best], best_distance
@@ -0,0 +1,69 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+DEFAULT_MAX_EDGE = 1024
+DEFAULT_QUALITY = 80
+
+
+def downscale_image(raw, max_edge=DEFAULT_MAX_EDGE, quality=DEFAULT_QUALITY):
+    # 長辺を max_edge 以下に縮小し、メタデータを落としてJPEGで再エンコードする
+    # 元より大きくなる場合は元のデータをそのまま返す
+    with Image.open(io.BytesIO(raw)) as img:
+        if img.format == 'JPEG':
+            # デコード時に1/2, 1/4, 1/8へ縮小できるドラフトモードを使う
+            img.draft('RGB', (max_edge, max_edge))
+        # メタデータを落とすとスマートフォンの写真が横向きになるので、先に向きを画素に反映する
+        img = ImageOps.exif_transpose(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((max_edge, max_edge))
+
+        buffer = io.BytesIO()
+        # exifなどを渡さないのでメタデータは保存されない
+        img.save(buffer, 'JPEG', quality=quality)
+
+    data = buffer.getvalue()
+    if len(data) >= len(raw):
+        return raw, None
+    return data, 'image/jpeg'
+
+
+class ImagePreprocessor:
+    """Vision API呼び出し前の画像縮小ステージ
+
+    executor を渡すとワーカープール上で実行する（ProcessPoolExecutorも可）。
+    """
+
+    def __init__(self, max_edge=DEFAULT_MAX_EDGE, quality=DEFAULT_QUALITY, executor=None):
+        self.max_edge = max_edge
+        self.quality = quality
+        self.executor = executor
+
+    def run(self, raw):
+        if self.executor is None:
+            return downscale_image(raw, self.max_edge, self.quality)
+        return self.executor.submit(downscale_image, raw, self.max_edge, self.quality).result()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+def make_preprocessor():
+    max_edge = int(os.getenv('PREPROCESS_MAX_EDGE', DEFAULT_MAX_EDGE))
+    if max_edge <= 0:
+        return None
+    quality = int(os.getenv('PREPROCESS_QUALITY', DEFAULT_QUALITY))
+
+    # PREPROCESS_WORKERS=0 ならリクエストのスレッドでそのまま実行する
+    workers = int(os.getenv('PREPROCESS_WORKERS', 0))
+    executor = None
+    if workers > 0:
+        if os.getenv('PREPROCESS_EXECUTOR', 'thread') == 'process':
+            executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preprocess')
+    return ImagePreprocessor(max_edge, quality, executor)
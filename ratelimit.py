@@ -0,0 +1,292 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import logs
+
+# 小さいほど先に送信する
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+# 送信レートを下げるきっかけになるステータスコード
+THROTTLE_STATUS_CODES = frozenset((429, 503))
+
+_priority = contextvars.ContextVar('calcam_priority', default=PRIORITY_INTERACTIVE)
+
+# 待機中のリクエストの状態
+_WAITING = 0
+_GRANTED = 1
+_REJECTED = 2
+_CANCELLED = 3
+
+
+class RateLimitExceeded(Exception):
+    """送信待ちの列が一杯、または待ち時間が上限を超えた"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class request_priority:
+    # with の中で送るGemini APIのリクエストの優先度を変える
+    __slots__ = ('level', 'token')
+
+    def __init__(self, level):
+        self.level = level
+
+    def __enter__(self):
+        self.token = _priority.set(self.level)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _priority.reset(self.token)
+        return False
+
+
+class _Waiter:
+    __slots__ = ('priority', 'seq', 'wake', 'state')
+
+    def __init__(self, priority, seq, wake):
+        self.priority = priority
+        self.seq = seq
+        self.wake = wake
+        self.state = _WAITING
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveRateLimiter:
+    """1つのモデルのエンドポイントに対するトークンバケット
+
+    429・503 を受けたら送信レートを乗算的に下げ、成功するたびに加算的に上げる（AIMD）。
+    トークンがなければ優先度順の列で待ち、列が一杯か max_wait 以内に送れない見込みなら
+    RateLimitExceeded で即座に断る。
+    """
+
+    def __init__(self, name, rate, min_rate, max_rate, burst, increase=1.0, decrease=0.5,
+                 cooldown=1.0, max_queue=64, max_wait=10.0):
+        self.name = name
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.burst = float(burst)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.tokens = self.burst
+        self.granted = 0
+        self.rejected = 0
+        self.throttled = 0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._queued = {}
+        self._seq = itertools.count()
+        self._thread = None
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _delay(self, now):
+        # 次のトークンが使えるまでの秒数
+        delay = max(self._blocked_until - now, 0.0)
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return delay
+
+    def _queued_ahead(self, priority):
+        return sum(count for level, count in self._queued.items() if level <= priority)
+
+    def _estimate_wait(self, now, priority):
+        return self._delay(now) + self._queued_ahead(priority) / self.rate
+
+    def _dequeue(self, waiter, state):
+        waiter.state = state
+        self._queued[waiter.priority] -= 1
+
+    def _reject(self, now, priority):
+        self.rejected += 1
+        retry_after = self._estimate_wait(now, priority)
+        return RateLimitExceeded(f'{self.name}の送信待ちが上限を超えました', retry_after)
+
+    def _make_room(self, priority):
+        # 列が一杯なら、自分より優先度の低い最後尾のリクエストを断って場所を空ける
+        candidates = [waiter for waiter in self._waiters
+                      if waiter.state == _WAITING and waiter.priority > priority]
+        if not candidates:
+            return False
+        victim = max(candidates)
+        self._dequeue(victim, _REJECTED)
+        victim.wake()
+        return True
+
+    def _enqueue(self, wake):
+        # ロックを保持した状態で呼び出すこと。すぐに送れる場合は None を返す
+        now = time.monotonic()
+        self._refill(now)
+        priority = _priority.get()
+        if not self._queued_ahead(priority) and self._delay(now) == 0:
+            self.tokens -= 1
+            self.granted += 1
+            return None
+
+        if sum(self._queued.values()) >= self.max_queue and not self._make_room(priority):
+            raise self._reject(now, priority)
+        if self._estimate_wait(now, priority) > self.max_wait:
+            raise self._reject(now, priority)
+
+        waiter = _Waiter(priority, next(self._seq), wake)
+        heapq.heappush(self._waiters, waiter)
+        self._queued[priority] = self._queued.get(priority, 0) + 1
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name=f'rate-limiter-{self.name}', daemon=True)
+            self._thread.start()
+        self._cond.notify()
+        return waiter
+
+    def _finish(self, waiter):
+        # ロックを保持した状態で呼び出すこと
+        if waiter.state == _GRANTED:
+            return
+        if waiter.state == _WAITING:
+            self._dequeue(waiter, _CANCELLED)
+        raise self._reject(time.monotonic(), waiter.priority)
+
+    def _run(self):
+        # 先頭のリクエストにトークンを渡す
+        with self._cond:
+            while True:
+                while self._waiters and self._waiters[0].state != _WAITING:
+                    heapq.heappop(self._waiters)
+                if not self._waiters:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                self._refill(now)
+                delay = self._delay(now)
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                waiter = heapq.heappop(self._waiters)
+                self._dequeue(waiter, _GRANTED)
+                self.tokens -= 1
+                self.granted += 1
+                waiter.wake()
+
+    def acquire(self):
+        event = threading.Event()
+        with self._cond:
+            waiter = self._enqueue(event.set)
+        if waiter is None:
+            return
+        event.wait(self.max_wait)
+        with self._cond:
+            self._finish(waiter)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            waiter = self._enqueue(lambda: loop.call_soon_threadsafe(_resolve, future))
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._cond:
+                if waiter.state == _WAITING:
+                    self._dequeue(waiter, _CANCELLED)
+            raise
+        with self._cond:
+            self._finish(waiter)
+
+    def on_response(self, status_code, retry_after=None):
+        with self._cond:
+            now = time.monotonic()
+            if status_code in THROTTLE_STATUS_CODES:
+                self.throttled += 1
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, now + retry_after)
+                # 同じ混雑で同時に返ってきた429で何度も下げないようにする
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    previous = self.rate
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self._refill(now)
+                    self.tokens = min(self.tokens, 0.0)
+                    logs.info('rate_limit_decreased', model=self.name, status_code=status_code,
+                              previous_rate=round(previous, 2), rate=round(self.rate, 2))
+            elif status_code < 500 and (sum(self._queued.values()) or self.tokens < 1):
+                # レートが実際に足りていないときだけ上げる
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'rate': self.rate,
+                'queued': sum(self._queued.values()),
+                'granted': self.granted,
+                'rejected': self.rejected,
+                'throttled': self.throttled,
+            }
+
+
+class RateLimiterRegistry:
+    """モデルのエンドポイントごとに AdaptiveRateLimiter を作って共有する"""
+
+    def __init__(self, **config):
+        self.config = config
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        # models/gemini-pro:generateContent → gemini-pro:generateContent
+        name = path.split('?', 1)[0].rsplit('/', 1)[-1]
+        limiter = self._limiters.get(name)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(name)
+                if limiter is None:
+                    limiter = self._limiters[name] = AdaptiveRateLimiter(name, **self.config)
+        return limiter
+
+    def stats(self):
+        return {name: limiter.stats() for name, limiter in list(self._limiters.items())}
+
+
+def make_rate_limiters():
+    # UPSTREAM_RATE_LIMIT=0 で無効
+    rate = float(os.getenv('UPSTREAM_RATE_LIMIT', 10))
+    if rate <= 0:
+        return None
+    return RateLimiterRegistry(
+        rate=rate,
+        min_rate=float(os.getenv('UPSTREAM_RATE_MIN', 0.5)),
+        max_rate=float(os.getenv('UPSTREAM_RATE_MAX', max(rate, 100))),
+        burst=float(os.getenv('UPSTREAM_RATE_BURST', max(rate, 1))),
+        max_queue=int(os.getenv('UPSTREAM_QUEUE_SIZE', 64)),
+        max_wait=float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', 10)),
+    )
+
+
+rate_limiters = make_rate_limiters()
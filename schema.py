@@ -0,0 +1,172 @@
+import json
+import math
+from dataclasses import dataclass
+
+
+class ResultParseError(ValueError):
+    pass
+
+
+@dataclass(slots=True)
+class Dish:
+    name: str
+    kcal: int
+    cooking_method: str = ''
+    portion: str = ''
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'kcal': self.kcal,
+            'cooking_method': self.cooking_method,
+            'portion': self.portion,
+        }
+
+
+@dataclass(slots=True)
+class CalorieResult:
+    dishes: list
+    total_kcal: int
+
+    def to_dict(self):
+        # /analyze のレスポンス形式
+        return {
+            'dishes': [dish.to_dict() for dish in self.dishes],
+            'total_kcal': self.total_kcal,
+        }
+
+
+_decoder = json.JSONDecoder()
+
+
+def extract_text(response):
+    # Gemini APIのレスポンスから最初の候補のテキストを取り出す
+    try:
+        parts = response['candidates'][0]['content']['parts']
+    except (KeyError, IndexError, TypeError):
+        raise ResultParseError('モデルの応答にテキストが含まれていません')
+    text = ''.join(part.get('text', '') for part in parts)
+    if not text:
+        raise ResultParseError('モデルの応答にテキストが含まれていません')
+    return text
+
+
+def extract_json(text):
+    # ```json ... ``` や前後の説明文が付いていても最初のJSONオブジェクトを取り出す
+    start = text.find('{')
+    while start != -1:
+        try:
+            value, _ = _decoder.raw_decode(text, start)
+        except ValueError:
+            start = text.find('{', start + 1)
+            continue
+        if isinstance(value, dict):
+            return value
+        start = text.find('{', start + 1)
+    raise ResultParseError('モデルの応答からJSONを取り出せませんでした')
+
+
+def _to_kcal(value, field):
+    if isinstance(value, bool):
+        raise ResultParseError(f'{field}が数値ではありません')
+    if isinstance(value, str):
+        try:
+            value = float(value.strip())
+        except ValueError:
+            raise ResultParseError(f'{field}が数値ではありません: {value}')
+    if not isinstance(value, (int, float)) or value < 0:
+        raise ResultParseError(f'{field}が不正な値です: {value}')
+    # NaNや無限大（1e999, "Infinity"）は整数にできない
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ResultParseError(f'{field}が不正な値です: {value}')
+    return int(round(value))
+
+
+def _to_text(value):
+    if value is None:
+        return ''
+    return value.strip() if isinstance(value, str) else str(value)
+
+
+def parse_dish(item):
+    if not isinstance(item, dict):
+        raise ResultParseError('dishesの要素がオブジェクトではありません')
+    name = item.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ResultParseError('料理名がありません')
+    return Dish(
+        name.strip(),
+        _to_kcal(item.get('kcal'), 'kcal'),
+        _to_text(item.get('cooking_method')),
+        _to_text(item.get('portion')),
+    )
+
+
+def parse_result(data):
+    dishes_data = data.get('dishes')
+    if not isinstance(dishes_data, list):
+        raise ResultParseError('dishesが配列ではありません')
+
+    dishes = [parse_dish(item) for item in dishes_data]
+
+    total_kcal = data.get('total_kcal')
+    if total_kcal is None:
+        total_kcal = sum(dish.kcal for dish in dishes)
+    else:
+        total_kcal = _to_kcal(total_kcal, 'total_kcal')
+    return CalorieResult(dishes, total_kcal)
+
+
+def parse_text(text):
+    return parse_result(extract_json(text))
+
+
+def parse_response(response):
+    return parse_text(extract_text(response))
+
+
+class StreamParser:
+    """1行に1つのJSONで届く分析結果を、行がそろった時点で Dish にする
+
+    料理の行は {"name": ..., "kcal": ...}、最後の行は {"total_kcal": ...}。
+    JSONでない行（前置きやコードブロックの記号）は読み飛ばす。
+    """
+
+    def __init__(self):
+        self.dishes = []
+        self.total_kcal = None
+        self._buffer = ''
+
+    def feed(self, text):
+        # 新しくそろった料理の一覧を返す
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split('\n')
+        return [dish for dish in map(self._parse_line, lines) if dish is not None]
+
+    def _parse_line(self, line):
+        line = line.strip().rstrip(',')
+        if not line.startswith('{'):
+            return None
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        if 'name' not in data and 'total_kcal' in data:
+            self.total_kcal = _to_kcal(data['total_kcal'], 'total_kcal')
+            return None
+        dish = parse_dish(data)
+        self.dishes.append(dish)
+        return dish
+
+    def close(self):
+        # 最後の行に改行がなくても読み、結果全体を返す
+        remaining, self._buffer = self._buffer, ''
+        self._parse_line(remaining)
+        if not self.dishes:
+            raise ResultParseError('モデルの応答から料理を読み取れませんでした')
+        total_kcal = self.total_kcal
+        if total_kcal is None:
+            total_kcal = sum(dish.kcal for dish in self.dishes)
+        return CalorieResult(self.dishes, total_kcal)
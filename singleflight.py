@@ -0,0 +1,96 @@
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class FlightAbandoned(Exception):
+    """最初のリクエストが結果を出す前に終了した（ストリームの切断など）"""
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら、その完了を待って結果を共有する（スレッド用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        # (結果, 他のリクエストの結果を共有したか) を返す
+        call, leader = self.begin(key)
+        if not leader:
+            return self.wait(call), True
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result, False
+
+    def begin(self, key):
+        # do() に関数を渡せない処理（結果を送りながら進むストリームなど）用。
+        # (呼び出し, 最初のリクエストか) を返す。最初なら finish() で結果を渡し、
+        # そうでなければ wait() で結果を受け取る
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def wait(self, call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def finish(self, key, call, result=None, error=None):
+        call.result = result
+        call.error = error
+        with self._lock:
+            del self._calls[key]
+        call.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """SingleFlight の asyncio 版
+
+    処理は独立したタスクで実行するので、最初のリクエストが切断されても
+    待っている他のリクエストには結果が返る。
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    async def do(self, key, fn, *args):
+        task = self._tasks.get(key)
+        if task is not None:
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(fn(*args))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._finish(key, task))
+        return await asyncio.shield(task), False
+
+    def _finish(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # 全員が切断した場合に「例外が取り出されなかった」警告を出さない
+        if not task.cancelled():
+            task.exception()
+
+    def in_flight(self):
+        return len(self._tasks)
@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import AsyncSingleFlight, SingleFlight
+
+# 同時に届く同じ画像のリクエスト数（連打や再送）
+DUPLICATES = 16
+
+
+def run_duplicates(flight, fn, key='image'):
+    # DUPLICATES 個のスレッドから同時に flight.do を呼び、(結果, 共有したか) か例外の一覧を返す
+    start = threading.Barrier(DUPLICATES + 1)
+    outcomes = [None] * DUPLICATES
+
+    def request(index):
+        start.wait()
+        try:
+            outcomes[index] = flight.do(key, fn)
+        except Exception as e:
+            outcomes[index] = e
+
+    threads = [threading.Thread(target=request, args=(index,)) for index in range(DUPLICATES)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    return threads, outcomes
+
+
+def test_concurrent_duplicates_make_one_upstream_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(threading.current_thread().name)
+        # 他のスレッドがすべて待ち始めるまで終わらない
+        release.wait(5)
+        return {'dishes': [], 'total_kcal': 650}
+
+    threads, outcomes = run_duplicates(flight, fn)
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    results = [result for result, _ in outcomes]
+    assert all(result is results[0] for result in results)
+    assert results[0] == {'dishes': [], 'total_kcal': 650}
+    assert sorted(shared for _, shared in outcomes) == [False] + [True] * (DUPLICATES - 1)
+    assert flight.in_flight() == 0
+
+
+def test_concurrent_duplicates_share_the_error():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        raise RuntimeError('upstream failed')
+
+    threads, outcomes = run_duplicates(flight, fn)
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert flight.in_flight() == 0
+
+
+def test_sequential_calls_are_not_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return len(calls)
+
+    assert flight.do('image', fn) == (1, False)
+    assert flight.do('image', fn) == (2, False)
+
+
+def test_async_concurrent_duplicates_make_one_upstream_call():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def fn(release):
+        calls.append(1)
+        await release.wait()
+        return {'dishes': [], 'total_kcal': 650}
+
+    async def main():
+        release = asyncio.Event()
+        requests = asyncio.gather(*(flight.do('image', fn, release) for _ in range(DUPLICATES)))
+        # すべてのリクエストが待ち始めてから upstream の応答を返す
+        await asyncio.sleep(0)
+        release.set()
+        return await requests
+
+    outcomes = asyncio.run(main())
+
+    assert len(calls) == 1
+    results = [result for result, _ in outcomes]
+    assert all(result is results[0] for result in results)
+    assert sorted(shared for _, shared in outcomes) == [False] + [True] * (DUPLICATES - 1)
+    assert flight.in_flight() == 0
+
+
+def test_async_followers_get_result_when_leader_is_cancelled():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def fn(release):
+        calls.append(1)
+        await release.wait()
+        return 650
+
+    async def main():
+        release = asyncio.Event()
+        leader = asyncio.ensure_future(flight.do('image', fn, release))
+        await asyncio.sleep(0)
+        followers = asyncio.gather(*(flight.do('image', fn, release) for _ in range(DUPLICATES - 1)))
+        await asyncio.sleep(0)
+        # 最初のリクエストのクライアントが切断しても処理は続く
+        leader.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await followers
+
+    outcomes = asyncio.run(main())
+
+    assert len(calls) == 1
+    assert outcomes == [(650, True)] * (DUPLICATES - 1)
@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import ratelimit
+
+# ローカルのスタブサーバーに向ける場合は GEMINI_API_BASE で上書きする
+DEFAULT_BASE_URL = 'https://generativelanguage.googleapis.com/v1beta/'
+
+
+class UpstreamTimeout(Exception):
+    """Gemini APIの応答がタイムアウトした（requests の Timeout を包む）"""
+
+
+# リトライ対象のステータスコード
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def parse_retry_after(value):
+    # Retry-Afterは秒数またはHTTP日付
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+class _BaseUpstreamClient:
+    # 同期・非同期クライアントで共通の設定とバックオフ計算
+
+    def __init__(self, base_url=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, backoff_base=None, backoff_max=None,
+                 pool_maxsize=None, rate_limiters=None):
+        base_url = base_url or os.getenv('GEMINI_API_BASE') or DEFAULT_BASE_URL
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.connect_timeout = connect_timeout or _env_float('UPSTREAM_CONNECT_TIMEOUT', 3.05)
+        self.read_timeout = read_timeout or _env_float('UPSTREAM_READ_TIMEOUT', 30.0)
+        self.max_retries = max_retries if max_retries is not None else _env_int('UPSTREAM_MAX_RETRIES', 2)
+        self.backoff_base = backoff_base or _env_float('UPSTREAM_BACKOFF_BASE', 0.5)
+        self.backoff_max = backoff_max or _env_float('UPSTREAM_BACKOFF_MAX', 8.0)
+        self.pool_maxsize = pool_maxsize or _env_int('UPSTREAM_POOL_MAXSIZE', 32)
+        # 同期・非同期のクライアントで同じ割り当てを使うので既定ではモジュール共通のものを使う
+        self.rate_limiters = rate_limiters or ratelimit.rate_limiters
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def _url(self, path):
+        return self.base_url + path.lstrip('/')
+
+    def _limiter(self, path):
+        if self.rate_limiters is None:
+            return None
+        return self.rate_limiters.get(path)
+
+    def _record_response(self, limiter, response):
+        if limiter is not None:
+            limiter.on_response(
+                response.status_code, parse_retry_after(response.headers.get('Retry-After')))
+
+    def _backoff(self, attempt, response=None):
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return min(retry_after, self.backoff_max)
+        # フルジッター付きの指数バックオフ
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+class UpstreamClient(_BaseUpstreamClient):
+    """Gemini API用の共有HTTPクライアント（コネクションプール・タイムアウト・リトライ付き）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        # requestsは読み込みが重いので、起動時ではなく最初の呼び出し時にセッションを作る
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def post_json(self, path, payload, headers=None):
+        return self._post(path, payload, headers, stream=False)
+
+    def post_stream(self, path, payload, headers=None):
+        # ステータスとヘッダーだけ読んで返す。本文は iter_sse_data で順に読む
+        return self._post(path, payload, headers, stream=True)
+
+    def _post(self, path, payload, headers, stream):
+        import requests
+
+        session = self.session
+        url = self._url(path)
+        limiter = self._limiter(path)
+        attempt = 0
+        while True:
+            # リトライも割り当てを消費するので毎回トークンを取る
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                response = session.post(
+                    url, json=payload, headers=headers, timeout=self.timeout, stream=stream)
+            except requests.exceptions.ConnectionError as e:
+                # 接続できなかった場合のみリトライ（読み取りタイムアウトはそのまま返す）
+                if attempt >= self.max_retries:
+                    # 接続タイムアウトは ConnectionError でもある
+                    if isinstance(e, requests.exceptions.Timeout):
+                        raise UpstreamTimeout(str(e)) from e
+                    raise
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            except requests.exceptions.Timeout as e:
+                raise UpstreamTimeout(str(e)) from e
+            self._record_response(limiter, response)
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                return response
+
+            delay = self._backoff(attempt, response)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+def iter_sse_data(response):
+    # Server-Sent Events の data をJSONとして届いた順に返す
+    # （Content-Typeに文字コードがないとrequestsはLatin-1とみなすので、バイト列のまま読む）
+    # Gemini APIはチャンク転送で返すので、chunk_size=None で届いたチャンクごとに処理できる
+    data_lines = []
+    for line in response.iter_lines(chunk_size=None):
+        if line.startswith(b'data:'):
+            data_lines.append(line[5:].strip())
+        elif not line and data_lines:
+            yield json.loads(b'\n'.join(data_lines))
+            data_lines = []
+    if data_lines:
+        yield json.loads(b'\n'.join(data_lines))
+
+
+class UpstreamResponse:
+    """非同期クライアントのレスポンス（requests.Response と同じ属性で読めるようにする）"""
+
+    __slots__ = ('status_code', 'headers', 'content')
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncUpstreamClient(_BaseUpstreamClient):
+    """asyncio版のクライアント。同時に送るリクエスト数をセマフォで制限する"""
+
+    def __init__(self, *args, max_concurrency=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_concurrency = max_concurrency or _env_int('UPSTREAM_MAX_CONCURRENCY', 64)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = None
+
+    def _get_session(self):
+        # aiohttpは非同期モードでのみ必要なのでここで読み込む
+        # セッションはイベントループ上で作る必要があるので初回の呼び出し時に作る
+        if self._session is None:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_concurrency, limit_per_host=self.max_concurrency),
+            )
+        return self._session
+
+    async def post_json(self, path, payload, headers=None):
+        import aiohttp
+
+        session = self._get_session()
+        url = self._url(path)
+        limiter = self._limiter(path)
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await limiter.acquire_async()
+            try:
+                async with self._semaphore:
+                    async with session.post(url, json=payload, headers=headers) as response:
+                        result = UpstreamResponse(
+                            response.status, response.headers, await response.read())
+            except aiohttp.ClientConnectionError as e:
+                # 接続できなかった場合のみリトライ（タイムアウトはそのまま返す）
+                if isinstance(e, asyncio.TimeoutError) or attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            self._record_response(limiter, result)
+
+            if result.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                return result
+
+            # 待機中はセマフォを解放しておく
+            await asyncio.sleep(self._backoff(attempt, result))
+            attempt += 1
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+upstream_client = UpstreamClient()